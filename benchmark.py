@@ -0,0 +1,272 @@
+"""
+Offline benchmarks of the pipeline stages on synthetic data.
+
+Synthetic archives mirror the layouts of the two data submodules: JHU daily reports in each of the three historical column schemas (plus the JHU time series files) and NYT us-states.csv, us-counties.csv and us.csv, at a configurable number of days and counties. Timings are written to a JSON file so that runs at different commits can be compared:
+
+    python3 benchmark.py --days 400 --counties 3000 --out bench-new.json --compare bench-old.json
+"""
+
+import os, sys, time, json, datetime, argparse, platform, subprocess, tempfile, statistics
+import numpy as np
+import pandas as pd
+import matplotlib
+from scrape import ALL_STATES, JHU_DAILY_TEMPLATE, JHU_TS_TEMPLATE, scrape_all_regions, scrape_all_counties
+from calculations import compute_doubling_time, compute_fold_change, compute_metrics
+from displays import generate_plot
+from manifest import plot_specs
+from instrument import peak_rss
+
+# countries other than the US, in the spellings of the early and of the later daily reports (see scrape.JHU_VALUE_RELABEL)
+SYNTHETIC_COUNTRIES = [('Mainland China', 'China'), ('Korea, South', 'Republic of Korea'), ('Iran (Islamic Republic of)', 'Iran'), ('United Kingdom', 'United Kingdom'),
+                       ('Canada', 'Canada'), ('Italy', 'Italy'), ('Spain', 'Spain'), ('Australia', 'Australia'), ('Germany', 'Germany'), ('France', 'France'), ('Japan', 'Japan'), ('Brazil', 'Brazil'), ('India', 'India')]
+PROVINCES_PER_COUNTRY = 3 # countries reported by province (China, Canada, Australia)
+
+def synthetic_curves(rng, n_days, n_series, scale=1e4):
+    """Cumulative counts (n_days x n_series) following logistic growth, with occasional downward revisions as in the real data
+    """
+    t = np.arange(n_days)[:, None]
+    size = rng.uniform(0.1, 1, n_series) * scale
+    rate = rng.uniform(0.05, 0.2, n_series)
+    midpoint = rng.uniform(0.3, 1, n_series) * n_days
+    curves = np.floor(size / (1 + np.exp(-rate * (t - midpoint))))
+    revised = rng.random(curves.shape) < 0.02
+    curves[revised] = np.floor(curves[revised] * 0.9)
+    return curves.astype(int)
+
+def generate_synthetic_data(root, n_days=120, n_counties=600, seed=0, end_date=None):
+    """Write a synthetic JHU and NYT archive under root, in the layouts that scrape.py reads
+
+    n_days : number of days, ending the day before end_date (default today, which is where scrape.py stops)
+    n_counties : number of US counties, spread over the states
+
+    Daily reports use the first JHU schema (Province/State, Country/Region, Last Update) for the first quarter of the days, the second (with Latitude/Longitude) for the second quarter, and the third (FIPS, Admin2, ..., Combined_Key, with one row per US county) for the rest.
+
+    Returns
+    -------
+    first date of the archive, to be passed as start_date to the scrape functions
+    """
+    rng = np.random.default_rng(seed)
+    end_date = end_date or datetime.date.today()
+    dates = [end_date - datetime.timedelta(days=n_days - day) for day in range(n_days)]
+    states = [s if s != 'DC' else 'District of Columbia' for s in ALL_STATES]
+
+    # US counties, spread evenly over the states
+    county_state = np.arange(n_counties) % len(states)
+    county_names = np.array([f'County {i // len(states)}' for i in range(n_counties)])
+    county_fips = 1000 * (county_state + 1) + np.arange(n_counties) // len(states)
+    county_confirmed = synthetic_curves(rng, n_days, n_counties)
+    county_deaths = county_confirmed // 50
+    state_confirmed = pd.DataFrame(county_confirmed.T).groupby(county_state).sum().values.T
+    state_deaths = pd.DataFrame(county_deaths.T).groupby(county_state).sum().values.T
+
+    # other countries, some of them by province
+    n_provinces = [PROVINCES_PER_COUNTRY if early in ('Mainland China', 'Canada', 'Australia') else 1 for early, late in SYNTHETIC_COUNTRIES]
+    country_idx = np.repeat(np.arange(len(SYNTHETIC_COUNTRIES)), n_provinces)
+    provinces = np.array([f'Province {p}' if n > 1 else np.nan for n in n_provinces for p in range(n)], dtype=object)
+    country_confirmed = synthetic_curves(rng, n_days, len(country_idx), scale=1e5)
+    country_deaths = country_confirmed // 30
+
+    ## JHU daily reports
+    jhu_dir = os.path.dirname(os.path.join(root, JHU_DAILY_TEMPLATE))
+    os.makedirs(jhu_dir, exist_ok=True)
+    for day, date in enumerate(dates):
+        schema = 0 if day < n_days // 4 else 1 if day < n_days // 2 else 2
+        names = np.array([SYNTHETIC_COUNTRIES[i][schema == 2] for i in country_idx], dtype=object)
+        last_update = f'{date}T12:00:00'
+        if schema < 2:
+            data = pd.DataFrame({'Province/State': np.concatenate([provinces, states]),
+                                 'Country/Region': np.concatenate([names, ['US'] * len(states)]),
+                                 'Last Update': last_update,
+                                 'Confirmed': np.concatenate([country_confirmed[day], state_confirmed[day]]),
+                                 'Deaths': np.concatenate([country_deaths[day], state_deaths[day]]),
+                                 'Recovered': 0})
+            if schema == 1:
+                data['Latitude'] = 0.
+                data['Longitude'] = 0.
+        else:
+            n_other = len(country_idx)
+            us_states = np.array(states, dtype=object)[county_state]
+            data = pd.DataFrame({'FIPS': np.concatenate([np.full(n_other, np.nan), county_fips]),
+                                 'Admin2': np.concatenate([np.full(n_other, np.nan, dtype=object), county_names]),
+                                 'Province_State': np.concatenate([provinces, us_states]),
+                                 'Country_Region': np.concatenate([names, ['US'] * n_counties]),
+                                 'Last_Update': last_update,
+                                 'Lat': 0., 'Long_': 0.,
+                                 'Confirmed': np.concatenate([country_confirmed[day], county_confirmed[day]]),
+                                 'Deaths': np.concatenate([country_deaths[day], county_deaths[day]]),
+                                 'Recovered': 0,
+                                 'Active': 0})
+            data['Combined_Key'] = data['Admin2'].fillna('') + ', ' + data['Province_State'].fillna('') + ', ' + data['Country_Region']
+        data.to_csv(os.path.join(root, JHU_DAILY_TEMPLATE.format(datestr=date.strftime('%m-%d-%Y'))), index=False)
+
+    ## JHU time series (global: one row per country/province, including a single US row; US: one row per county)
+    date_cols = [f'{d.month}/{d.day}/{d:%y}' for d in dates]
+    ts_dir = os.path.dirname(os.path.join(root, JHU_TS_TEMPLATE))
+    os.makedirs(ts_dir, exist_ok=True)
+    names = [SYNTHETIC_COUNTRIES[i][1] for i in country_idx]
+    for var, other, counties in [('confirmed', country_confirmed, county_confirmed), ('deaths', country_deaths, county_deaths)]:
+        glob = pd.DataFrame({'Province/State': list(provinces) + [np.nan], 'Country/Region': names + ['US'], 'Lat': 0., 'Long': 0.})
+        glob = pd.concat([glob, pd.DataFrame(np.hstack([other, counties.sum(axis=1, keepdims=True)]).T, columns=date_cols)], axis=1)
+        glob.to_csv(os.path.join(root, JHU_TS_TEMPLATE.format(var=var, scope='global')), index=False)
+        us = pd.DataFrame({'FIPS': county_fips, 'Admin2': county_names, 'Province_State': np.array(states)[county_state], 'Country_Region': 'US', 'Lat': 0., 'Long_': 0.})
+        us = pd.concat([us, pd.DataFrame(counties.T, columns=date_cols)], axis=1)
+        us.to_csv(os.path.join(root, JHU_TS_TEMPLATE.format(var=var, scope='US')), index=False)
+
+    ## NYT tables (a county appears from its first case onwards)
+    nyt_dir = os.path.join(root, 'covid-19-data')
+    os.makedirs(nyt_dir, exist_ok=True)
+    day, county = np.nonzero(county_confirmed > 0)
+    counties = pd.DataFrame({'date': np.array([str(d) for d in dates])[day],
+                             'county': county_names[county],
+                             'state': np.array(states)[county_state[county]],
+                             'fips': county_fips[county],
+                             'cases': county_confirmed[day, county],
+                             'deaths': county_deaths[day, county]})
+    counties.to_csv(os.path.join(nyt_dir, 'us-counties.csv'), index=False)
+    us_states = counties.groupby(['date', 'state'], sort=False, as_index=False)[['cases', 'deaths']].sum()
+    us_states.insert(2, 'fips', 0)
+    us_states.to_csv(os.path.join(nyt_dir, 'us-states.csv'), index=False)
+    counties.groupby('date', as_index=False)[['cases', 'deaths']].sum().to_csv(os.path.join(nyt_dir, 'us.csv'), index=False)
+
+    return dates[0]
+
+def time_call(fn, repeat=3):
+    """Call fn repeat times and return (last result, list of wall times in seconds)
+    """
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t0)
+    return result, times
+
+# modules whose import time is measured; importing main must not pull in the plotting stack
+STARTUP_MODULES = ['scrape', 'calculations', 'displays', 'main', 'matplotlib.pyplot']
+
+def time_import(module, repeat=3):
+    """Wall times in seconds of importing a module in a fresh interpreter (excluding interpreter startup)
+    """
+    code = f'import time; t0 = time.perf_counter(); import {module}; print(time.perf_counter() - t0)'
+    here = os.path.dirname(os.path.abspath(__file__))
+    return [float(subprocess.run([sys.executable, '-c', code], cwd=here, check=True, capture_output=True, text=True).stdout) for _ in range(repeat)]
+
+# the county stage, measured on its own: scraped, corrected, calculated and saved as main.run_counties does
+COUNTY_STAGE = """
+import os, sys, json, datetime
+from scrape import scrape_all_counties
+from calculations import compute_metrics
+from storage import save_frame
+from instrument import peak_rss
+root, start_date, out_dir = sys.argv[1], datetime.date.fromisoformat(sys.argv[2]), sys.argv[3]
+before = peak_rss()
+scraped = scrape_all_counties(var_to_track=['Deaths', 'Confirmed'], start_date=start_date, data_dir=os.path.join(root, 'covid-19-data'), corrections=[])
+after_scrape = peak_rss()
+for var, data in scraped.items():
+    save_frame(data, os.path.join(out_dir, f'scraped_data_us_counties-{var}.csv'))
+    cube = compute_metrics(data, metrics={'doubling_time': [3], 'fold_change': [3]})
+    for kind in ['doubling_time', 'fold_change']:
+        save_frame(cube[kind, 3], os.path.join(out_dir, f'{kind}_us_counties-{var}.csv'))
+print(json.dumps(dict(imports=before, scrape=after_scrape, total=peak_rss())))
+"""
+
+def measure_county_peak(root, start_date):
+    """Peak resident memory in bytes of the county stage in a fresh interpreter (the peak of a process never goes down, so it cannot be measured after the other benchmarks)
+
+    Returns
+    -------
+    dict of the peak after the imports, after scraping and at the end
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as out_dir:
+        output = subprocess.run([sys.executable, '-c', COUNTY_STAGE, root, str(start_date), out_dir], cwd=here, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().split('\n')[-1])
+
+def run_benchmarks(root, start_date, repeat=3, var_to_track='Deaths'):
+    """Time the imports and then each pipeline stage on the archive under root, without caches
+
+    Returns
+    -------
+    dict of benchmark name -> dict(min, median, repeat) in seconds
+    """
+    kw = dict(var_to_track=var_to_track, start_date=start_date, data_dir=os.path.join(root, 'covid-19-data'), cache_dir=None)
+    results = {}
+    def record(name, times):
+        results[name] = dict(min=min(times), median=statistics.median(times), repeat=repeat)
+        print(f'{name:48s} {min(times):9.4f} s')
+    def bench(name, fn):
+        result, times = time_call(fn, repeat=repeat)
+        record(name, times)
+        return result
+
+    for module in STARTUP_MODULES:
+        record(f'import[{module}]', time_import(module, repeat=repeat))
+
+    regions = bench('scrape_all_regions[jhu]', lambda: scrape_all_regions(source='jhu', data_src_template=os.path.join(root, JHU_DAILY_TEMPLATE), **kw))
+    bench('scrape_all_regions[jhu_ts]', lambda: scrape_all_regions(source='jhu_ts', data_src_template=os.path.join(root, JHU_TS_TEMPLATE), **kw))
+    bench('scrape_all_regions[nyt]', lambda: scrape_all_regions(source='nyt', data_src_template=os.path.join(root, JHU_DAILY_TEMPLATE), **kw))
+    counties = bench('scrape_all_counties', lambda: scrape_all_counties(**kw))
+
+    for name, data in [('regions', regions), ('counties', counties)]:
+        bench(f'compute_doubling_time[{name}]', lambda: compute_doubling_time(data))
+        bench(f'compute_fold_change[{name}]', lambda: compute_fold_change(data))
+        bench(f'compute_metrics[{name}]', lambda: compute_metrics(data))
+
+    # one US and one world plot, rendered from scratch
+    calculated = compute_doubling_time(regions)
+    out_dir = os.path.join(root, 'images')
+    for spec in plot_specs('doubling_time', var_to_track):
+        if spec['name'].endswith(('_US-states', '_world')):
+            bench(f'generate_plot[{spec["name"]}]', lambda: generate_plot(calculated, out_dir=out_dir, **spec))
+
+    return results
+
+def environment():
+    """Versions and commit the benchmarks ran at
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return dict(commit=commit, python=platform.python_version(), numpy=np.__version__, pandas=pd.__version__, matplotlib=matplotlib.__version__, machine=platform.machine(), cpus=os.cpu_count())
+
+def compare(results, previous, county_peak=None):
+    """Print the ratio of each timing, and of the peak memory of the county stage, to those of a previous run
+    """
+    print(f'\nCompared with {previous.get("environment", {}).get("commit")} (ratio < 1 is faster):')
+    for name, res in results.items():
+        if name in previous['results']:
+            print(f'{name:48s} {res["min"] / previous["results"][name]["min"]:9.2f}x')
+    if county_peak and 'county_peak_rss_bytes' in previous:
+        print(f'{"peak RSS of the county stage":48s} {county_peak["total"] / previous["county_peak_rss_bytes"]["total"]:9.2f}x')
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--days', type=int, default=120, help='number of days of synthetic data')
+    parser.add_argument('--counties', type=int, default=600, help='number of synthetic US counties')
+    parser.add_argument('--repeat', type=int, default=3, help='timed calls per benchmark (the minimum is reported)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', help='where to write the synthetic archive (default: a temporary directory, removed afterwards)')
+    parser.add_argument('--out', help='json file to write the timings to')
+    parser.add_argument('--compare', help='json file of a previous run to compare against')
+    args = parser.parse_args(args)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = args.data_dir or tmp
+        t0 = time.perf_counter()
+        start_date = generate_synthetic_data(root, n_days=args.days, n_counties=args.counties, seed=args.seed)
+        print(f'Generated {args.days} days x {args.counties} counties in {time.perf_counter() - t0:.1f} s.\n')
+        results = run_benchmarks(root, start_date, repeat=args.repeat)
+        county_peak = measure_county_peak(root, start_date)
+        print(f'\n{"peak RSS of the county stage":48s} {county_peak["total"] / 2**20:9.1f} MiB (imports {county_peak["imports"] / 2**20:.1f} MiB, after scraping {county_peak["scrape"] / 2**20:.1f} MiB)')
+
+    report = dict(environment=environment(), days=args.days, counties=args.counties, seed=args.seed, peak_rss_bytes=peak_rss(), county_peak_rss_bytes=county_peak, results=results)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f), county_peak)
+    return report
+
+if __name__ == '__main__':
+    main()
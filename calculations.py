@@ -1,21 +1,36 @@
 import numpy as np
 import pandas as pd
+from storage import as_frame, OffsetTable
 
 calculation_descriptions = {
-        'fold_change': 'Fold change in\n{var} compared\nwith 3 days prior',
-        'doubling_time': 'Time for {var}\nto double\n(days)'
+        'fold_change': 'Fold change in\n{var} compared\nwith {n} days prior',
+        'doubling_time': 'Time for {var}\nto double\n(days)',
+        'daily_new': 'New {var}\nper day',
+        'daily_new_average': 'New {var}\nper day\n({n}-day average)',
+        'regression_doubling_time': 'Time for {var}\nto double\n(days, {n}-day fit)',
+        }
+
+# metrics computed by compute_metrics, with the windows (in days) each is computed for
+METRICS = {
+        'daily_new': [1],
+        'daily_new_average': [7],
+        'fold_change': [3, 7],
+        'doubling_time': [3, 7, 14],
+        'regression_doubling_time': [7, 14],
         }
 
 var_replacements = {
         'confirmed': 'cases'
         }
 
-def c_str(kind, var):
+def c_str(kind, var, n_days=3):
     var = var_replacements.get(var.lower(), var.lower())
-    return calculation_descriptions[kind].format(var=var)
+    return calculation_descriptions[kind].format(var=var, n=n_days)
 
 def calculate(kind, *args, **kwargs):
     """Wrapper for all relevant calculations in this module.
+
+    Kinds other than fold_change and doubling_time are taken from compute_metrics, for a window of n_days (default 3).
     """
 
     if kind == 'fold_change':
@@ -24,14 +39,18 @@ def calculate(kind, *args, **kwargs):
     elif kind == 'doubling_time':
         return compute_doubling_time(*args, **kwargs)
 
+    elif kind in METRICS:
+        n_days = kwargs.pop('n_days', 3)
+        return compute_metrics(*args, metrics={kind: [n_days]}, **kwargs)[kind, n_days]
+
 def compute_fold_change(filename, n_days=3):
     """For each column, compute daily fold change relative to n days prior
 
-    filename: path to scraped data table
+    filename: path to scraped data table, or the table itself
     """
 
     # load data
-    data = pd.read_csv(filename, index_col=0)
+    data = as_frame(filename)
 
     # fold change over N days
     fold_change = data.pct_change(n_days) + 1 # +1 for pct change to fold
@@ -41,11 +60,11 @@ def compute_fold_change(filename, n_days=3):
 def compute_doubling_time(filename, n_days=3):
     """For each column, compute daily doubling time estimate, defined as ln(2)/ln(growth rate). Growth rate estimate for any given day is made using change relative to n_days ago.
 
-    filename: path to scraped data table
+    filename: path to scraped data table, or the table itself
     """
 
     # load data
-    data = pd.read_csv(filename, index_col=0)
+    data = as_frame(filename)
 
     # pct change
     change = data.pct_change(n_days)
@@ -59,10 +78,111 @@ def compute_doubling_time(filename, n_days=3):
 
     return dtime_days
     
+def compute_metrics(filename, metrics=METRICS):
+    """Compute several metrics, each for several windows, over every column in one pass
+
+    filename: path to scraped data table (cumulative counts), or the table itself
+    metrics: dict of metric name -> list of windows in days, see METRICS
+        daily_new : new counts per day (window ignored)
+        daily_new_average : trailing mean of daily new counts over the window
+        fold_change, doubling_time : as compute_fold_change and compute_doubling_time with n_days = window
+        regression_doubling_time : ln(2) / slope of a least-squares line through the log counts of the trailing window
+
+    Intermediates shared by several metrics (daily new counts, the change relative to n days prior and the log counts) are computed once.
+
+    Returns
+    -------
+    DataFrame indexed by date, with (metric, window, region) column levels: the metric x window x date x region cube. Slicing a metric and window, e.g. `cube['doubling_time', 3]`, gives a date x region table like those of compute_doubling_time.
+
+    For an OffsetTable (e.g. the county tables of scrape_all_counties) the cube is computed a block of columns at a time and returned as a dict of (metric, window) -> OffsetTable, sliced the same way, so that memory stays proportional to the observations.
+    """
+
+    if isinstance(filename, OffsetTable):
+        blocks = {}
+        for columns in filename.column_blocks():
+            cube = compute_metrics(filename.block_frame(columns), metrics=metrics)
+            for metric, windows in metrics.items():
+                for n in windows:
+                    blocks.setdefault((metric, n), []).append(OffsetTable.from_dense(cube[metric, n].values, filename.index, filename.columns[columns], fill=np.nan))
+        return {label: OffsetTable.concat(parts) for label, parts in blocks.items()}
+
+    # load data
+    data = as_frame(filename)
+    values = data.values.astype(float)
+    n_dates = len(values)
+
+    def shift(arr, n):
+        out = np.full_like(arr, np.nan)
+        out[n:] = arr[:n_dates - n]
+        return out
+
+    def rolling_sum(arr, n):
+        # sum over the trailing n days, NaN unless all n values are present
+        start = np.zeros((1, arr.shape[1]))
+        missing = np.isnan(arr)
+        cum = np.cumsum(np.vstack([start, np.where(missing, 0, arr)]), axis=0)
+        gaps = np.cumsum(np.vstack([start, missing]), axis=0)
+        out = np.full_like(arr, np.nan)
+        out[n - 1:] = np.where(gaps[n:] > gaps[:n_dates - n + 1], np.nan, cum[n:] - cum[:n_dates - n + 1])
+        return out
+
+    # shared intermediates, computed on first use
+    cache = {}
+    def shared(name, n, fn):
+        if (name, n) not in cache:
+            cache[name, n] = fn()
+        return cache[name, n]
+    daily_new = lambda: shared('daily_new', 1, lambda: values - shift(values, 1))
+    change = lambda n: shared('change', n, lambda: values / shift(values, n) - 1)
+    log_counts = lambda: shared('log_counts', 0, lambda: np.log(np.where(values > 0, values, np.nan)))
+
+    def regression_doubling_time(n):
+        # slope of log counts against day, over the trailing n days, from centered days and the logs relative to the first day of each window,
+        # so that a flat window gives a slope of exactly 0 (an infinite doubling time) rather than the rounding error of large cumulative sums
+        logs = log_counts()
+        n_windows = max(n_dates - n + 1, 0)
+        first = logs[:n_windows]
+        numerator = np.zeros_like(first)
+        for k in range(n):
+            numerator += (k - (n - 1) / 2) * (logs[k:k + n_windows] - first)
+        slope = np.full_like(logs, np.nan)
+        slope[n - 1:] = numerator / (n * (n ** 2 - 1) / 12)
+        return np.log(2) / slope
+
+    compute = {
+            'daily_new': lambda n: daily_new(),
+            'daily_new_average': lambda n: rolling_sum(daily_new(), n) / n,
+            'fold_change': lambda n: change(n) + 1,
+            'doubling_time': lambda n: np.log(2) / np.log(1 + change(n)) * n,
+            'regression_doubling_time': regression_doubling_time,
+            }
+
+    blocks, labels = [], []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for metric, windows in metrics.items():
+            for n in sorted(windows):
+                blocks.append(compute[metric](n))
+                labels.append((metric, n))
+
+    # columns ordered like their level codes (metrics in the given order, windows ascending, regions as in the data), so that slicing is fast
+    metric_level = list(metrics)
+    window_level = sorted({n for metric, n in labels})
+    n_regions = data.shape[1]
+    columns = pd.MultiIndex(levels=[metric_level, window_level, data.columns],
+                            codes=[np.repeat([metric_level.index(m) for m, n in labels], n_regions),
+                                   np.repeat([window_level.index(n) for m, n in labels], n_regions),
+                                   np.tile(np.arange(n_regions), len(labels))],
+                            names=['metric', 'window', 'region'])
+    return pd.DataFrame(np.hstack(blocks), index=data.index, columns=columns)
+
 def compute_top_n(filename, n=3, method='last'):
+    """Names of the n columns with the largest valid last (or summed) values
+
+    filename: path to data table, or the table itself
+    """
 
     # load data
-    data = pd.read_csv(filename, index_col=0)
+    data = as_frame(filename)
 
     if method == 'last':
         vals = data.iloc[-1]
@@ -1,13 +1,9 @@
-import os
-import matplotlib.pyplot as pl
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib.transforms import blended_transform_factory as blend
-import seaborn as sns
-from imageio import imwrite
-from PIL import Image
+import os, shutil, hashlib
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-import datetime
+from storage import as_frame
+from instrument import stage, count, add_stage
 
 # In general, numeric values can be adjusted here as desired, unless comments specify otherwise
 
@@ -43,74 +39,85 @@ data_label_x = 0.38
 ylims = (0.0, None)
 
 # line formatting
-sns_cols = [(0, 0, 0)] + sns.color_palette('deep') + sns.color_palette('dark')
+# (black, then seaborn's 'deep' and 'dark' palettes, stored here so that seaborn is not needed)
+sns_cols = ['#000000',
+            '#4c72b0', '#dd8452', '#55a868', '#c44e52', '#8172b3', '#937860', '#da8bc3', '#8c8c8c', '#ccb974', '#64b5cd',
+            '#001c7f', '#b1400d', '#12711c', '#8c0800', '#591e71', '#592f0d', '#a23582', '#3c3c3c', '#b8850a', '#006374']
 data_linewidth = 4 * size_scale
 data_line_color = 'darkslateblue'
 
+# image outputs, all written from a single drawing of each plot
+extra_formats = ['webp'] # formats written besides the main one (generate_plot's `fmt`), at full size and as thumbnails
+thumbnail_widths = [400] # pixel widths of downscaled copies, saved as {name}-{width}w.{format}
+webp_quality = 80 # lossy webp quality (0-100); None for lossless
+webp_method = 2 # webp encoder effort (0-6); above 2 files barely shrink while encoding takes several times longer
+write_svg = False # also save each plot as svg (drawn a second time, since vector output cannot come from the rendered pixels)
+
+# render cache
+render_cache_max_bytes = 200 * 2**20 # least recently used images are evicted beyond this size
+
+# parameters above that determine how a plot looks, and thus enter the render cache key along with this module's code
+aesthetic_params = ['clip_value', 'fig_size', 'ax_box', 'ax_box_simple', 'tfs', 'lfs', 'ylfs', 'xtkfs', 'ytkfs', 'tpad', 'tlen', 'title_pos', 'ylab_pos', 'min_dist', 'data_label_x', 'ylims', 'sns_cols', 'data_linewidth', 'data_line_color', 'extra_formats', 'thumbnail_widths', 'webp_quality', 'webp_method', 'write_svg']
+
 
 def choose_y(pos, priors, ax, min_dist=min_dist, inc=0.01):
     """Adjust a y coordinate such that it stays a min distance from list of other coordinates
 
     min_dist in axes coordinates
     pos and priors in data coordinates
-    """
-    
-    # setup transform functions
-    axes_to_data = (ax.transAxes + ax.transData.inverted())
-    data_to_axes = (axes_to_data.inverted())
-    def dat2ax_delta(delta, y):
-        """Convert a delta on y axis at position y, from data to axes coords.
-        Difference from pos to pos+delta (as opposed to 0+delta) needed only for log scale where position on y axis influences relative scale
-        """
-        p1 = data_to_axes.transform((0, y))[1]
-        p2 = data_to_axes.transform((0, y + delta))[1]
-        return p2 - p1
 
-    def get_dif(pos, priors):
-        """As best ypos is searched for, distances to other labels are computed in axes coords so they can be compared to min_dist also in axes_coords, especially important when log scale because position on scale determines size of delta
+    Labels are placed in order from highest to lowest, so the new label has to go below all priors, more than min_dist away from each. Positions are snapped to a grid of `inc` spanning the axes, all of which are checked at once, and the allowed position closest to pos is chosen; if no grid position is allowed, the label goes min_dist below the lowest prior.
+    """
 
-        This function accepts all in data coordinates
-        """
-        dif = pos - priors
-        dif = np.array([dat2ax_delta(i, pos) for i in dif])
-        return dif
-    
     if len(priors) == 0:
         return pos
-    priors = np.array(priors)
-    
-    # run through a range of positions and compute the closest label at each one
+    priors = np.asarray(priors, dtype=float)
     possible = np.arange(-0.4, 1.4, inc) # span entire axes coordinates
-    mins = []
-    for poss in possible:
-        poss = axes_to_data.transform((0, poss))[1] # convert temporarily to data coordinates
-        closest = np.min(np.abs(get_dif(poss, priors))) # distance of the closest other label if we place at poss
-        mins.append(closest)
-    mins = np.array(mins)
-
-    # find positions where min meets distance criteria, then choose closest one
-    meets_dist_critera = mins > min_dist
-    contenders = possible[meets_dist_critera]
-    # back to data coords to find option that is closest to originally desired value
-    contenders = np.array([axes_to_data.transform((0, i))[1] for i in contenders])
-    # confirm that labels will be in order of data points
-    is_below_priors = contenders < np.min(priors)
-    contenders = contenders[is_below_priors]
-    best = np.argmin(np.abs(contenders - pos))
-    pos = contenders[best]
-    
-    return pos
-
-def generate_plot(filename, columns, title='', ylabel='', log=False, bolds=[], min_date=None, name='plot', out_dir='images', fmt='png', runaway_zone=False, simplified=False, simp_fs_mult=1):
+    column = lambda y: np.column_stack([np.zeros(len(y)), y])
+
+    if ax.get_yscale() == 'linear':
+        # distances computed as by the original search (delta at each position converted from data to axes coords), so that positions exactly min_dist apart resolve the same way
+        axes_to_data = ax.transAxes + ax.transData.inverted()
+        data_to_axes = axes_to_data.inverted()
+        possible_data = axes_to_data.transform(column(possible))[:, 1]
+        dif = possible_data[:, None] - priors[None, :]
+        moved = data_to_axes.transform(column((possible_data[:, None] + dif).ravel()))[:, 1].reshape(dif.shape)
+        dif_ax = moved - data_to_axes.transform(column(possible_data))[:, 1][:, None]
+        allowed = (np.min(np.abs(dif_ax), axis=1) > min_dist) & (possible_data < np.min(priors))
+        contenders = possible_data[allowed]
+        if len(contenders):
+            return contenders[np.argmin(np.abs(contenders - pos))]
+        return axes_to_data.transform((0, data_to_axes.transform((0, np.min(priors)))[1] - min_dist))[1]
+
+    # log scale: distances in axes coordinates, where a label's height is the same anywhere on the axis
+    data_to_axes = ax.transData + ax.transAxes.inverted()
+    axes_to_data = data_to_axes.inverted()
+    ys = data_to_axes.transform(column(np.concatenate([[pos], priors])))[:, 1]
+    target, priors_ax = ys[0], ys[1:]
+    lowest = np.nanmin(priors_ax)
+    contenders = possible[lowest - possible > min_dist]
+    if len(contenders) == 0:
+        best = lowest - min_dist
+    else:
+        if not np.isfinite(target):
+            target = lowest
+        best = contenders[np.argmin(np.abs(contenders - target))]
+
+    return axes_to_data.transform((0, best))[1]
+
+def generate_plot(filename, columns, title='', ylabel='', log=False, bolds=[], min_date=None, name='plot', out_dir='images', fmt='png', runaway_zone=False, simplified=False, simp_fs_mult=1, cache_dir=None):
     """Generate plot and return path to saved figure image
 
-    filename : relative path to csv with values to plot
+    filename : relative path to csv with values to plot, or the calculated table itself (which is not modified)
     columns : str of list thereof of column names to plots
     title : optional string at title on plot
     ylabel : optional string as ylabel on plot
     log : use log scale on y axis
     bolds : list of indices parallel to `columns` whose label to bold
     min_date : minimum date to plot
+    cache_dir : optional render cache directory; if an identical plot (same data shown, parameters, and aesthetics) was rendered before, its images are copied instead of drawn again
+
+    Besides `{name}.{fmt}`, the figure is saved in the `extra_formats` and as thumbnails at the `thumbnail_widths`, all from the one drawing (see image_outputs).
 
     The parameters for the function are limited to those that will likely be changed on a plot-to-plot basis. The remainder of the parameters for plotting are specified at the top of this `displays` module.
     """
@@ -122,7 +129,7 @@ def generate_plot(filename, columns, title='', ylabel='', log=False, bolds=[], m
         title = columns[0]
 
     # load data
-    data = pd.read_csv(filename, index_col=0)
+    data = as_frame(filename).copy()
 
     new_columns = []
     for col in columns:
@@ -148,15 +155,18 @@ def generate_plot(filename, columns, title='', ylabel='', log=False, bolds=[], m
         data = data[pd.to_datetime(data.index) >= min_date]
     data[data==0] = np.nan
 
-    # setup axes
-    fig = pl.figure(figsize=fig_size)
-    canvas = FigureCanvas(fig)
+    # reuse an identical earlier rendering if there is one
+    outputs = image_outputs(name, out_dir, fmt)
+    path = outputs[0][0]
+    if cache_dir is not None:
+        key = render_key(data[columns], columns=columns, title=title, ylabel=ylabel, log=log, bolds=bolds, fmt=fmt, runaway_zone=runaway_zone, simplified=simplified, simp_fs_mult=simp_fs_mult)
+        if _render_cache_get(cache_dir, key, name, outputs):
+            count('images_from_cache')
+            return path
 
-    ax = None
-    if simplified:
-        ax = fig.add_axes(ax_box_simple)
-    else:
-        ax = fig.add_axes(ax_box) 
+    # setup axes: the static parts of the figure are built once per layout, see FigureTemplate
+    template = figure_template(simplified=simplified, log=log, runaway_zone=runaway_zone, simp_fs_mult=simp_fs_mult)
+    fig, canvas, ax = template.fig, template.canvas, template.ax
 
     # plot data
     colors = sns_cols[:len(columns)]
@@ -184,23 +194,10 @@ def generate_plot(filename, columns, title='', ylabel='', log=False, bolds=[], m
 
         # plot line
         ax.plot(xdata, ydata, lw=lw, color=data_line_color)
+    if all(y == -1 for y in last_ys):
+        raise ValueError(f'No values to plot in {name}: every value is missing, zero or above {clip_value}')
 
-    # plot reference data
-    if runaway_zone:
-        ref = 3
-        ax.axhspan(0, ref, color='lightcoral', alpha=0.2, lw=0)
-        xpos = 0.25 if simplified else 0.2
-        ax.text(xpos, .04, 'RUNAWAY SPREAD', fontsize=(lfs-2)*simp_fs_mult if simplified else (lfs-2), color='red', zorder=150, ha='center', va='center', weight='bold', transform=ax.transAxes, alpha=0.8)
-
-    # axes/spines aesthetics
-    ax.spines['top'].set_visible(False)
-    ax.spines['right'].set_visible(False)
-    ax.spines['left'].set_visible(True)
-    ax.spines['bottom'].set_visible(True)
-    
-    # y scale
-    if log:
-        ax.set_yscale('log')
+    # y limits
     if not log:
         ax.set_ylim(ylims)
 
@@ -234,7 +231,7 @@ def generate_plot(filename, columns, title='', ylabel='', log=False, bolds=[], m
     if not log:
         ax.set_yticks(int_range)
 
-    # tick params
+    # tick params (after the ticks are chosen: the default locator takes the label size into account)
     ax.tick_params(pad=tpad, length=tlen)
     ax.tick_params(axis='x', labelsize=xtkfs * simp_fs_mult if simplified else xtkfs)
     ax.tick_params(axis='y', labelsize=ytkfs * simp_fs_mult if simplified else ytkfs)
@@ -279,26 +276,272 @@ def generate_plot(filename, columns, title='', ylabel='', log=False, bolds=[], m
         ax.text(title_pos[0], title_pos[1], title, fontsize=tfs, weight='bold', ha='left', va='center', transform=ax.transAxes)
     ax.text(ylab_pos[0], ylab_pos[1], ylabel, fontsize=ylfs, ha='center', va='center', transform=ax.transAxes)
 
-    # convert to image in numpy array
-    #canvas.draw()
-    #s, (width, height) = canvas.print_to_buffer()
-    #arr_img = np.fromstring(s, np.uint8).reshape((height, width, 4))
-
-    # save image
+    # save images
     os.makedirs(out_dir, exist_ok=True)
-    path = os.path.join(out_dir, f'{name}.{fmt}')
-    pl.savefig(path)
+    _save_outputs(fig, canvas, outputs)
+    count('images_written')
 
-    pl.close(fig)
+    if cache_dir is not None:
+        _render_cache_put(cache_dir, key, name, outputs)
     return path
 
+class FigureTemplate:
+    """A figure with the parts that are the same for every plot of one layout already drawn in: axes, spines, y scale and the runaway zone
+
+    generate_plot draws into it after `reset`, which removes the lines and labels of the previous plot; the images are the same as from a new figure.
+    """
+
+    def __init__(self, simplified=False, log=False, runaway_zone=False, simp_fs_mult=1):
+        # the plotting stack is only imported once a plot is actually drawn
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+
+        self.log = log
+        self.fig = fig = Figure(figsize=fig_size)
+        self.canvas = FigureCanvas(fig)
+        self.ax = ax = fig.add_axes(ax_box_simple if simplified else ax_box)
+
+        # reference data
+        if runaway_zone:
+            ref = 3
+            ax.axhspan(0, ref, color='lightcoral', alpha=0.2, lw=0)
+            xpos = 0.25 if simplified else 0.2
+            ax.text(xpos, .04, 'RUNAWAY SPREAD', fontsize=(lfs-2)*simp_fs_mult if simplified else (lfs-2), color='red', zorder=150, ha='center', va='center', weight='bold', transform=ax.transAxes, alpha=0.8)
+
+        # axes/spines aesthetics
+        ax.spines['top'].set_visible(False)
+        ax.spines['right'].set_visible(False)
+        ax.spines['left'].set_visible(True)
+        ax.spines['bottom'].set_visible(True)
+
+        # y scale
+        if log:
+            ax.set_yscale('log')
+
+        self.static_texts = list(ax.texts)
+
+    def reset(self):
+        """Remove the data lines and labels of the previous plot and undo its limits and ticks
+        """
+        from matplotlib import rcParams
+        from matplotlib.ticker import AutoLocator
+
+        ax = self.ax
+        for artist in list(ax.lines) + [t for t in ax.texts if t not in self.static_texts]:
+            artist.remove()
+        ax.relim() # data limits of the remaining (static) artists only
+        ax.set_autoscalex_on(True)
+        ax.set_autoscaley_on(True) # turned off by the limits set for the previous plot
+        # default label sizes, which the number of default ticks depends on
+        ax.tick_params(axis='x', labelsize=rcParams['xtick.labelsize'])
+        ax.tick_params(axis='y', labelsize=rcParams['ytick.labelsize'])
+        if not self.log:
+            ax.yaxis.set_major_locator(AutoLocator()) # generate_plot reads the default ticks before setting its own
+
+_templates = {} # layout -> FigureTemplate, per process
+
+def figure_template(simplified=False, log=False, runaway_zone=False, simp_fs_mult=1):
+    """The FigureTemplate of a layout, reset and ready to draw a plot into
+    """
+    layout = (simplified, log, runaway_zone, simp_fs_mult, repr([globals()[p] for p in aesthetic_params]))
+    if layout not in _templates:
+        _templates[layout] = FigureTemplate(simplified=simplified, log=log, runaway_zone=runaway_zone, simp_fs_mult=simp_fs_mult)
+    template = _templates[layout]
+    template.reset()
+    return template
+
+def image_outputs(name, out_dir='images', fmt='png'):
+    """Every image file written for one plot, as (path, format, width) tuples; the first is the full size image in the main format, width is None for full size images
+    """
+    formats = list(dict.fromkeys([fmt] + extra_formats))
+    outputs = [(os.path.join(out_dir, f'{name}.{f}'), f, None) for f in formats]
+    outputs += [(os.path.join(out_dir, f'{name}-{w}w.{f}'), f, w) for w in thumbnail_widths for f in formats]
+    if write_svg and 'svg' not in formats:
+        outputs.append((os.path.join(out_dir, f'{name}.svg'), 'svg', None))
+    return outputs
+
+def thumbnail_path(path, width, fmt=None):
+    """Path of the thumbnail of an image at a given width (and optionally in another format)
+    """
+    stem, ext = os.path.splitext(path)
+    return f'{stem}-{width}w.{fmt or ext[1:]}'
+
+def _save_outputs(fig, canvas, outputs):
+    """Draw the figure once and write all its raster outputs from the rendered pixels
+    """
+    import matplotlib.image
+    from PIL import Image
+
+    canvas.draw()
+    rgba = np.asarray(canvas.buffer_rgba())
+    height, full_width = rgba.shape[:2]
+    thumbnails = {}
+    for path, fmt, width in outputs:
+        if fmt == 'svg':
+            fig.savefig(path, format='svg')
+            continue
+        pixels, dpi = rgba, fig.dpi
+        if width is not None:
+            if width not in thumbnails:
+                size = (width, int(round(height * width / full_width)))
+                thumbnails[width] = np.asarray(Image.fromarray(rgba).resize(size, Image.LANCZOS))
+            pixels, dpi = thumbnails[width], fig.dpi * width / full_width
+        pil_kwargs = None
+        if fmt == 'webp':
+            pil_kwargs = dict(method=webp_method, **(dict(lossless=True) if webp_quality is None else dict(quality=webp_quality)))
+        # the same call savefig makes for raster formats, without drawing again
+        matplotlib.image.imsave(path, pixels, format=fmt, origin='upper', dpi=dpi, pil_kwargs=pil_kwargs)
+
+def style_key():
+    """Hash of everything besides data and plot parameters that determines how plots look: the aesthetic parameters of this module, its code, and the matplotlib version
+    """
+    h = hashlib.sha1()
+    h.update(repr([(p, globals()[p]) for p in aesthetic_params]).encode())
+    with open(__file__, 'rb') as f:
+        h.update(f.read())
+    h.update(_matplotlib_version().encode())
+    return h.hexdigest()
+
+def _matplotlib_version():
+    # without importing matplotlib, so that unchanged plots can be skipped cheaply
+    try:
+        from importlib.metadata import version
+        return version('matplotlib')
+    except ImportError: # python < 3.8
+        import matplotlib
+        return matplotlib.__version__
+
+def render_key(data, **params):
+    """Content address of a plot: hash of the exact data shown, the plot parameters, and style_key()
+
+    data : the processed values to be drawn, with their dates
+    """
+    h = hashlib.sha1(style_key().encode())
+    h.update(repr(sorted(params.items())).encode())
+    h.update(repr([str(i) for i in data.index]).encode())
+    h.update(repr(list(data.columns)).encode())
+    h.update(np.ascontiguousarray(data.values, dtype=float).tobytes())
+    return h.hexdigest()
+
+def _cached_path(cache_dir, key, name, path):
+    # the cache entry of an output is the render key plus what follows the plot name in its file name (e.g. `.png`, `-400w.webp`)
+    return os.path.join(cache_dir, key + os.path.basename(path)[len(name):])
+
+def _render_cache_get(cache_dir, key, name, outputs):
+    """Copy the cached images of a plot to their paths if all are present, return whether they were
+    """
+    try:
+        for path, fmt, width in outputs:
+            cached = _cached_path(cache_dir, key, name, path)
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            shutil.copyfile(cached, path)
+            os.utime(cached) # mark as recently used
+    except FileNotFoundError: # not cached, or evicted meanwhile
+        return False
+    return True
+
+def _render_cache_put(cache_dir, key, name, outputs, max_bytes=None):
+    """Store the rendered images of a plot in the cache, then evict least recently used images beyond max_bytes
+    """
+    if max_bytes is None:
+        max_bytes = render_cache_max_bytes
+    os.makedirs(cache_dir, exist_ok=True)
+    stored = set()
+    for path, fmt, width in outputs:
+        cached = _cached_path(cache_dir, key, name, path)
+        shutil.copyfile(path, cached + '.tmp')
+        os.replace(cached + '.tmp', cached)
+        stored.add(cached)
+
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and not entry.name.endswith('.tmp'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, old in sorted(entries):
+        if total <= max_bytes:
+            break
+        if old in stored:
+            continue
+        try:
+            os.remove(old)
+        except FileNotFoundError: # evicted by another worker
+            pass
+        total -= size
+
+def generate_plots(filename, specs, workers=None, pool=None):
+    """Generate many plots of the same calculated table and return paths to the saved figure images, in the order of `specs`
+
+    filename : relative path to csv with values to plot, or the calculated table itself
+    specs : list of dicts of keyword arguments to generate_plot (columns, bolds, log, runaway_zone, min_date, name, simplified, simp_fs_mult, ...)
+    workers : number of worker processes to render with; None uses all cores, 1 renders sequentially in this process
+    pool : optional running pool (see plot_pool) to render with instead, e.g. kept by a long-running process so that its workers keep their figure templates between calls; `workers` is then ignored
+
+    Each worker receives the table once, when it starts; a pool kept between calls is sent the columns of each plot instead. Images are identical to those rendered sequentially.
+    """
+    data = as_frame(filename)
+    if pool is not None:
+        columns = lambda spec: spec['columns'] if isinstance(spec['columns'], (list, np.ndarray)) else [spec['columns']]
+        results = list(pool.map(_plot_columns_worker, [(data[list(columns(spec))], spec) for spec in specs]))
+        for path, record in results:
+            add_stage(record)
+        return [path for path, record in results]
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(specs))
+
+    if workers <= 1:
+        return [_timed_plot(data, spec)[0] for spec in specs]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_plot_worker, initargs=(data,)) as pool:
+        results = list(pool.map(_plot_worker, specs))
+    # stage records and counters of the workers are reported in this process
+    for path, record in results:
+        add_stage(record)
+    return [path for path, record in results]
+
+def _timed_plot(data, spec):
+    with stage('generate_plot', plot=spec.get('name')) as record:
+        path = generate_plot(data, **spec)
+    return path, record
+
+_worker_data = None
+
+def _init_plot_worker(data):
+    global _worker_data
+    _worker_data = data
+
+def _plot_worker(spec):
+    return _timed_plot(_worker_data, spec)
+
+def _plot_columns_worker(args):
+    return _timed_plot(*args)
+
+def plot_pool(workers=None):
+    """A pool of worker processes for generate_plots to render with across calls; None uses all cores. Shut it down when done.
+    """
+    return ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+
 def generate_html(paths, pixel_width=200):
-    
+    """Write test_webpage.html showing a thumbnail of each image, linked to the full size image
+
+    paths : paths to full size images, as returned by generate_plot
+    pixel_width : displayed width; the smallest thumbnail at least this wide is used (webp where available, with the main format as fallback)
+    """
     img_tags = []
     for path in paths:
         width = pixel_width
         height = int(round(fig_size[1] *  pixel_width / fig_size[0]))
-        img_tag = f'<div><img src="{path}" width="{width}" height="{height}"></div>'
+        src = path
+        widths = sorted(w for w in thumbnail_widths if w >= pixel_width)
+        if widths:
+            src = thumbnail_path(path, widths[0])
+        img_tag = f'<img src="{src}" width="{width}" height="{height}">'
+        if src != path and 'webp' in extra_formats and not path.endswith('.webp'):
+            img_tag = f'<picture><source srcset="{thumbnail_path(path, widths[0], "webp")}" type="image/webp">{img_tag}</picture>'
+        img_tag = f'<div><a href="{path}">{img_tag}</a></div>'
         img_tags.append(img_tag)
 
     # dump images to simple webpage for quick inspection
@@ -0,0 +1,112 @@
+"""
+Run instrumentation: wall/cpu time and peak memory of each pipeline stage, plus counters (files read, rows parsed, images written).
+
+Stages are recorded with `stage`, counters with `count`; `write_report` dumps both as a JSON run report and `profile` runs a function under cProfile and tracemalloc.
+"""
+
+import os, sys, io, time, json, datetime, contextlib, cProfile, pstats, tracemalloc
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+counters = {} # name -> count, for the whole run
+stages = [] # one record per finished stage, in order of completion
+
+def count(name, n=1):
+    """Add n to a run counter
+    """
+    counters[name] = counters.get(name, 0) + int(n)
+
+def peak_rss(children=False):
+    """Peak resident set size in bytes of this process (or of its largest finished child process), None where unavailable
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024 # bytes on macOS, kilobytes elsewhere
+
+@contextlib.contextmanager
+def stage(name, **info):
+    """Time a block of code and record it as a stage of the run
+
+    info : extra fields for the record (e.g. variable, calculation kind, plot name)
+
+    The record holds wall and cpu seconds, the peak RSS of the process at the end of the stage and the counters incremented during it.
+    """
+    record = dict(stage=name, **info)
+    before = dict(counters)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        record['wall_s'] = round(time.perf_counter() - wall, 4)
+        record['cpu_s'] = round(time.process_time() - cpu, 4)
+        record['peak_rss_bytes'] = peak_rss()
+        record['counters'] = {k: v - before.get(k, 0) for k, v in counters.items() if v != before.get(k, 0)}
+        stages.append(record)
+
+def add_stage(record):
+    """Add a stage recorded in another process (e.g. a plot worker), along with its counters
+    """
+    stages.append(record)
+    for k, v in record.get('counters', {}).items():
+        count(k, v)
+
+def reset():
+    counters.clear()
+    del stages[:]
+
+def report(**info):
+    """Run report as a dict: totals per stage name, every stage record, counters and peak memory
+    """
+    totals = {}
+    for record in stages:
+        total = totals.setdefault(record['stage'], dict(calls=0, wall_s=0., cpu_s=0.))
+        total['calls'] += 1
+        total['wall_s'] = round(total['wall_s'] + record['wall_s'], 4)
+        total['cpu_s'] = round(total['cpu_s'] + record['cpu_s'], 4)
+
+    return dict(info,
+                finished=datetime.datetime.now().isoformat(timespec='seconds'),
+                peak_rss_bytes=peak_rss(),
+                peak_rss_children_bytes=peak_rss(children=True),
+                counters=dict(counters),
+                totals=totals,
+                stages=list(stages))
+
+def write_report(filename, **info):
+    """Write the run report as JSON (atomically) and return its path
+    """
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(report(**info), f, indent=1)
+    os.replace(filename + '.tmp', filename)
+    return filename
+
+def profile(fn, *args, out='profile', n_lines=40, **kwargs):
+    """Call fn(*args, **kwargs) under cProfile and tracemalloc and return its result
+
+    out : path prefix of the dumps; `{out}.prof` holds the raw cProfile stats (for pstats/snakeviz), `{out}.txt` the top functions by cumulative time and the top allocation sites
+    """
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    try:
+        result = profiler.runcall(fn, *args, **kwargs)
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+        profiler.dump_stats(f'{out}.prof')
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(n_lines)
+        text.write(f'tracemalloc: {current / 2**20:.1f} MiB allocated at exit, {peak / 2**20:.1f} MiB peak\n\n')
+        for stat in snapshot.statistics('lineno')[:n_lines]:
+            text.write(f'{stat}\n')
+        with open(f'{out}.txt', 'w') as f:
+            f.write(text.getvalue())
+        print(f'Profile written to {out}.prof and {out}.txt.')
+
+    return result
@@ -11,162 +11,129 @@ It is run using the run.sh bash script which first pulls down new data.
 
 import os, sys
 import pandas as pd
-from scrape import scrape_all_regions, ALL_US_REGIONS, scrape_all_counties
-from calculations import calculate, compute_top_n, c_str
-from displays import generate_plot, generate_html
-
-# Coarsely parse script arguments
-args = sys.argv
-if 'Deaths' in args or 'death' in args:
-    var_to_track = 'Deaths'
-elif 'Confirmed' in args or 'confirmed' in args:
-    var_to_track = 'Confirmed'
-else:
-    var_to_track = 'Deaths'
+from scrape import scrape_all_regions, scrape_all_counties, load_groupings
+from calculations import compute_metrics
+from manifest import render_manifest
+from storage import save_frame
+from webtable import save_table_data
+import instrument
+from instrument import stage
 
 # Default parameters
-calculation_kind = 'doubling_time' # doubling_time / fold_change
-show_n_days = 25
-scraped_data_filename = f'data/scraped_data-{var_to_track}.csv'
-scraped_data_usc_filename = f'data/scraped_data_us_counties-{var_to_track}.csv'
-calculated_filename = f'data/{calculation_kind}-{var_to_track}.csv'
-calculated_usc_filename = f'data/{calculation_kind}_us_counties-{var_to_track}.csv'
-runaway_zone = calculation_kind == 'doubling_time'
-log = calculation_kind == 'fold_change'
+variables = ['Deaths'] # Deaths / Confirmed
+calculation_kinds = ['doubling_time'] # doubling_time / fold_change
+calculation_window = 3 # days over which the calculation kinds above are computed
 output_reverse_csv = True
-analyze_us_counties = False # may take a few mins
-data_source = 'jhu' if 'jhu' in args else 'nyt' # jhu / nyt  (will default to jhu for country data)
-
-## Step 1: scrape and save to file
-data = scrape_all_regions(var_to_track=var_to_track, source=data_source)
-os.makedirs('data', exist_ok=True)
-data.to_csv(scraped_data_filename)
-
-## Step 2: run calculation
-calculated = calculate(calculation_kind, scraped_data_filename)
-calculated.to_csv(calculated_filename)
-
-if output_reverse_csv:
-    calculated_reversed = calculated.sort_index(axis=0, ascending=False)
-    calculated_reversed_filename = f'data/{calculation_kind}-{var_to_track}-reversed.csv'
-    calculated_reversed.to_csv(calculated_reversed_filename)
-
-
-## Step 3: generate and save plots
-ylab = c_str(calculation_kind, var_to_track)
-min_date = pd.Timestamp.today() - pd.to_timedelta(show_n_days, unit='D')
-min_date_states = max(min_date, pd.to_datetime('2020-3-6'))
-
-for name, states in ALL_US_REGIONS.items():
-    name_1 = f'{calculation_kind}_{var_to_track}_US-{name}'
-    columns = states
-    columns.insert(0, name)
-    path_1 = generate_plot(calculated_filename,
-                        columns,
-                        ylabel=ylab,
-                        bolds=[0],
-                        log=log,
-                        runaway_zone=runaway_zone,
-                        min_date=min_date_states,
-                        name=name_1)
-
-# Plot 1
-name_1 = f'{calculation_kind}_{var_to_track}_US-states'
-columns = ['US', 'New York', 'New Jersey', 'Washington', 'Ohio', 'Florida']
-path_1 = generate_plot(calculated_filename,
-                       columns,
-                       ylabel=ylab,
-                       bolds=[0],
-                       log=log,
-                       runaway_zone=runaway_zone,
-                       min_date=min_date_states,
-                       name=name_1)
-# Plot 1a
-name_1 = f'{calculation_kind}_{var_to_track}_US-states-simple'
-columns = ['US', 'New York', 'New Jersey', 'Washington', 'Ohio', 'Florida']
-path_1 = generate_plot(calculated_filename,
-                       columns,
-                       ylabel=ylab,
-                       bolds=[0],
-                       log=log,
-                       runaway_zone=runaway_zone,
-                       min_date=min_date_states,
-                       name=name_1,
-                       simplified=True,
-                       simp_fs_mult=1.8)
-
-# Plot 2
-name_2 = f'{calculation_kind}_{var_to_track}_US-regions'
-columns = ['US', 'Midwest', 'Northeast', 'Rockies', 'Southeast', 'Southwest', 'Pacific']
-path_2 = generate_plot(calculated_filename,
-                       columns,
-                       ylabel=ylab,
-                       bolds=[0],
-                       log=log,
-                       runaway_zone=runaway_zone,
-                       min_date=min_date_states,
-                       name=name_2)
-
-# Plot 2a
-name_2a = f'{calculation_kind}_{var_to_track}_US-regions-alternate'
-columns = ['US', 'Midwest', 'Northeast', 'Rockies', 'Southeast-', 'Mid-Atlantic', 'Southwest', 'Pacific']
-path_2a = generate_plot(calculated_filename,
-                       columns,
-                       ylabel=ylab,
-                       bolds=[0],
-                       log=log,
-                       runaway_zone=runaway_zone,
-                       min_date=min_date_states,
-                       name=name_2a)
-
-# Plot 2b
-name_2 = f'{calculation_kind}_{var_to_track}_US-regions-simple'
-columns = ['US', 'Midwest', 'Northeast', 'Rockies', 'Southeast', 'Southwest', 'Pacific']
-path_2 = generate_plot(calculated_filename,
-                       columns,
-                       bolds=[0],
-                       log=log,
-                       runaway_zone=runaway_zone,
-                       min_date=min_date_states,
-                       name=name_2,
-                       simplified=True,
-                       simp_fs_mult=1.8)
-
-
-# Plot 3
-name_3 = f'{calculation_kind}_{var_to_track}_world'
-columns = ['World', 'Italy', 'South Korea', 'France', 'Iran', 'US', 'UK']
-if var_to_track == 'Confirmed':
-    columns.remove('South Korea')
-path_3 = generate_plot(calculated_filename,
-                       columns,
-                       ylabel=ylab,
-                       bolds=[0],
-                       log=log,
-                       runaway_zone=runaway_zone,
-                       min_date=min_date,
-                       name=name_3)
-
-# plot 3a
-name_3 = f'{calculation_kind}_{var_to_track}_world-simple'
-columns = ['World', 'Italy', 'South Korea', 'France', 'Iran', 'US', 'UK']
-if var_to_track == 'Confirmed':
-    columns.remove('South Korea')
-path_3 = generate_plot(calculated_filename,
-                       columns,
-                       ylabel=ylab,
-                       bolds=[0],
-                       log=log,
-                       runaway_zone=runaway_zone,
-                       min_date=min_date,
-                       name=name_3,
-                       simplified=True,
-                       simp_fs_mult=1.3)
-
-
-## Step 4: analyze US counties (optional)
-if analyze_us_counties:
-    data = scrape_all_counties()
-    data.to_csv(scraped_data_usc_filename)
-    calculated = calculate(calculation_kind, scraped_data_usc_filename)
-    calculated.to_csv(calculated_usc_filename)
+table_variable = 'Deaths' # variable shown in the web table (covid19-table.html), written to data/covid19-table.json
+analyze_us_counties = True
+data_source = 'nyt' # jhu / jhu_ts / nyt  (will default to jhu for country data)
+groupings_file = 'groupings.json' # user-defined state groupings and county groupings (e.g. metro areas), see scrape.load_groupings
+cache_dir = 'cache' # parsed source files are kept here so that later runs only parse new/changed files
+scrape_workers = None # processes used to parse JHU daily reports not in the cache (None: one per core)
+plot_workers = None # processes used to render plots (None: one per core)
+render_state_file = os.path.join(cache_dir, 'render_state.json') # plots whose data and parameters are unchanged since they were last rendered are skipped
+render_cache_dir = os.path.join(cache_dir, 'renders') # images of identical plots are copied from here instead of drawn again
+run_report_file = 'run_report.json' # timings, counters and peak memory of each stage of the last run (kept out of data/, which is published)
+profile_prefix = 'profile' # with --profile, cProfile/tracemalloc stats are written to profile.prof and profile.txt
+
+def parse_args(args):
+    """Coarsely parse script arguments into variables, calculation kinds and data source
+
+    e.g. `python3 main.py deaths confirmed doubling_time fold_change`
+    (`--profile` is handled when run as a script, see the bottom of this file)
+    """
+    var_names = {'deaths': 'Deaths', 'death': 'Deaths', 'confirmed': 'Confirmed'}
+    vars_ = [var_names[a.lower()] for a in args if a.lower() in var_names]
+    kinds = [a for a in args if a in ('doubling_time', 'fold_change')]
+    source = 'jhu_ts' if 'jhu_ts' in args else 'jhu' if 'jhu' in args else data_source
+    return (list(dict.fromkeys(vars_)) or variables,
+            list(dict.fromkeys(kinds)) or calculation_kinds,
+            source)
+
+def run(variables=variables, calculation_kinds=calculation_kinds, data_source=data_source, regions=True, counties=analyze_us_counties, state=None):
+    """Scrape once for all variables, then calculate and plot every (variable, calculation kind) pair
+
+    regions, counties : which parts of the workflow to run (states/countries and their plots, and US counties)
+    state : dict kept from one call to the next by a long-running process (see watch.py), so that a part that is not rerun keeps its previous corrections; it may also hold
+        'tables' : dict in which the parsed source tables are kept between runs instead of being loaded from cache_dir each time (see scrape.scrape_all_regions)
+        'plot_pool' : running pool of processes to render the plots with, which keep their figure templates between runs (see displays.plot_pool)
+    """
+    state = {} if state is None else state
+    corrections = state.setdefault('corrections', {}) # part -> cells changed to keep cumulative series non-decreasing
+    tables, pool = state.get('tables'), state.get('plot_pool')
+
+    instrument.reset()
+    groupings = load_groupings(groupings_file) if os.path.exists(groupings_file) else {}
+    os.makedirs('data', exist_ok=True)
+    if regions:
+        run_regions(variables, calculation_kinds, data_source, groupings, corrections=corrections.setdefault('regions', []), tables=tables, pool=pool)
+    if counties:
+        run_counties(variables, calculation_kinds, groupings, corrections=corrections.setdefault('counties', []), tables=tables)
+
+    # record of corrected values, to audit data revisions
+    corrections = [c for part in corrections.values() for c in part]
+    if corrections:
+        corrections = pd.concat(corrections, ignore_index=True)
+        corrections[['variable', 'date', 'region', 'reported', 'corrected']].to_csv('data/corrections.csv', index=False)
+
+    instrument.write_report(run_report_file, variables=variables, calculation_kinds=calculation_kinds, data_source=data_source)
+    if instrument.peak_rss() is not None:
+        print(f'Peak memory (RSS): {instrument.peak_rss() / 2**20:.0f} MiB; see {run_report_file} for each stage.')
+
+def run_regions(variables, calculation_kinds, data_source, groupings, corrections, tables=None, pool=None):
+    """Steps 1-3 for states, countries and their groupings
+    """
+    del corrections[:] # replaced by those of this run
+
+    ## Step 1: scrape and save to file
+    # (tables are passed between steps in memory; files are csv for the web table plus npz copies for reloading)
+    with stage('scrape_all_regions', source=data_source):
+        scraped = scrape_all_regions(var_to_track=variables, source=data_source, cache_dir=cache_dir, memory=tables, corrections=corrections, groupings=groupings.get('state', {}), workers=scrape_workers)
+    for var_to_track, data in scraped.items():
+        save_frame(data, f'data/scraped_data-{var_to_track}.csv')
+
+    for var_to_track in variables:
+
+        ## Step 2: compute the metrics that are saved below in one pass (the others of calculations.METRICS are computed on request by serve.py)
+        metrics = {kind: [calculation_window] for kind in calculation_kinds}
+        if var_to_track == table_variable:
+            metrics.setdefault('doubling_time', [calculation_window]) # for the web table
+        with stage('compute_metrics', variable=var_to_track):
+            cube = compute_metrics(scraped[var_to_track], metrics=metrics)
+
+        if var_to_track == table_variable:
+            save_table_data(scraped[var_to_track], cube['doubling_time', calculation_window])
+
+        for calculation_kind in calculation_kinds:
+            calculated = cube[calculation_kind, calculation_window]
+            save_frame(calculated, f'data/{calculation_kind}-{var_to_track}.csv')
+
+            if output_reverse_csv:
+                calculated_reversed = calculated.sort_index(axis=0, ascending=False)
+                calculated_reversed_filename = f'data/{calculation_kind}-{var_to_track}-reversed.csv'
+                calculated_reversed.to_csv(calculated_reversed_filename)
+
+            ## Step 3: generate and save plots (all plots are listed in manifest.PLOT_MANIFEST)
+            with stage('render_manifest', kind=calculation_kind, variable=var_to_track):
+                render_manifest(calculated, calculation_kind, var_to_track, state_file=render_state_file, render_cache_dir=render_cache_dir, workers=plot_workers, pool=pool)
+
+def run_counties(variables, calculation_kinds, groupings, corrections, tables=None):
+    """Step 4: analyze US counties (optional, see analyze_us_counties)
+    """
+    del corrections[:]
+    with stage('scrape_all_counties'):
+        scraped_usc = scrape_all_counties(var_to_track=variables, cache_dir=cache_dir, memory=tables, corrections=corrections, groupings=groupings.get('county', {}))
+    for var_to_track, data in scraped_usc.items():
+        save_frame(data, f'data/scraped_data_us_counties-{var_to_track}.csv')
+        with stage('compute_metrics', variable=var_to_track, counties=True):
+            cube = compute_metrics(data, metrics={kind: [calculation_window] for kind in calculation_kinds})
+        for calculation_kind in calculation_kinds:
+            calculated = cube[calculation_kind, calculation_window]
+            save_frame(calculated, f'data/{calculation_kind}_us_counties-{var_to_track}.csv')
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if '--profile' in args:
+        instrument.profile(run, *parse_args(args), out=profile_prefix)
+    else:
+        run(*parse_args(args))
@@ -0,0 +1,118 @@
+"""
+Declarative list of every plot produced by main.py, and a planner to render it.
+
+Each entry of PLOT_MANIFEST yields one plot per (calculation kind, variable) pair, named `{calculation_kind}_{var_to_track}_{name}`. A new chart is a new entry here.
+"""
+
+import os, json, hashlib
+import numpy as np
+import pandas as pd
+from scrape import ALL_US_REGIONS
+from calculations import c_str
+from displays import generate_plots, style_key, image_outputs
+from storage import as_frame
+
+# date windows
+show_n_days = 25
+us_start = '2020-3-6' # US plots never start before this date
+
+# Manifest entries: keyword arguments to displays.generate_plot, plus
+#   name : suffix of the image name
+#   window : 'us' (last show_n_days, but not before us_start) or 'world' (last show_n_days)
+#   ylabel : whether to label the y axis with the calculation description (default True)
+#   exclude : dict of variable -> columns to leave out for that variable
+PLOT_MANIFEST = [
+    # one plot per US region with its states
+    *[dict(name=f'US-{name}', columns=[name] + states, window='us') for name, states in ALL_US_REGIONS.items()],
+
+    dict(name='US-states', columns=['US', 'New York', 'New Jersey', 'Washington', 'Ohio', 'Florida'], window='us'),
+    dict(name='US-states-simple', columns=['US', 'New York', 'New Jersey', 'Washington', 'Ohio', 'Florida'], window='us', simplified=True, simp_fs_mult=1.8),
+
+    dict(name='US-regions', columns=['US', 'Midwest', 'Northeast', 'Rockies', 'Southeast', 'Southwest', 'Pacific'], window='us'),
+    dict(name='US-regions-alternate', columns=['US', 'Midwest', 'Northeast', 'Rockies', 'Southeast-', 'Mid-Atlantic', 'Southwest', 'Pacific'], window='us'),
+    dict(name='US-regions-simple', columns=['US', 'Midwest', 'Northeast', 'Rockies', 'Southeast', 'Southwest', 'Pacific'], window='us', ylabel=False, simplified=True, simp_fs_mult=1.8),
+
+    dict(name='world', columns=['World', 'Italy', 'South Korea', 'France', 'Iran', 'US', 'UK'], window='world', exclude={'Confirmed': ['South Korea']}),
+    dict(name='world-simple', columns=['World', 'Italy', 'South Korea', 'France', 'Iran', 'US', 'UK'], window='world', exclude={'Confirmed': ['South Korea']}, simplified=True, simp_fs_mult=1.3),
+]
+
+def plot_specs(calculation_kind, var_to_track, manifest=PLOT_MANIFEST):
+    """Expand the manifest into keyword arguments for displays.generate_plot, for one calculation of one variable
+    """
+    min_date = pd.Timestamp.today() - pd.to_timedelta(show_n_days, unit='D')
+    min_dates = {'world': min_date,
+                 'us': max(min_date, pd.to_datetime(us_start))}
+
+    specs = []
+    for entry in manifest:
+        entry = dict(entry)
+        exclude = entry.pop('exclude', {}).get(var_to_track, [])
+        spec = dict(bolds=[0],
+                    log=calculation_kind == 'fold_change',
+                    runaway_zone=calculation_kind == 'doubling_time')
+        if entry.pop('ylabel', True):
+            spec['ylabel'] = c_str(calculation_kind, var_to_track)
+        spec['min_date'] = min_dates[entry.pop('window')]
+        spec.update(entry)
+        spec['columns'] = [c for c in spec['columns'] if c not in exclude]
+        spec['name'] = f'{calculation_kind}_{var_to_track}_{spec["name"]}'
+        specs.append(spec)
+
+    return specs
+
+def required_columns(specs):
+    """Union of the columns needed by a list of plot specs, in order of first use
+    """
+    return list(dict.fromkeys(c for spec in specs for c in spec['columns']))
+
+def plot_key(data, spec):
+    """Hash of everything a plot is drawn from: its parameters, the values of its columns, and the plot aesthetics (displays.style_key)
+
+    The min date enters as the first date it actually lets through, so that the key does not change with the time of day.
+    """
+    params = dict(spec)
+    if params.get('min_date') is not None:
+        shown = data.index[pd.to_datetime(data.index) >= params['min_date']]
+        params['min_date'] = str(shown[0]) if len(shown) else None
+
+    h = hashlib.sha1(style_key().encode())
+    h.update(repr(sorted(params.items())).encode())
+    h.update(np.asarray(pd.to_datetime(data.index).values, dtype='datetime64[ns]').tobytes())
+    h.update(np.ascontiguousarray(data[spec['columns']].values, dtype=float).tobytes())
+    return h.hexdigest()
+
+def render_manifest(calculated, calculation_kind, var_to_track, manifest=PLOT_MANIFEST, state_file=None, render_cache_dir=None, workers=None, pool=None, out_dir='images', fmt='png'):
+    """Render every plot of the manifest for one calculation of one variable and return the paths to the full size images in the main format
+
+    calculated : calculated table, or path to it
+    state_file : optional json file recording the key of each rendered plot; plots whose key is unchanged and whose images (see displays.image_outputs) all exist are not rendered again
+    render_cache_dir : optional content-addressed cache of rendered images, see displays.generate_plot
+    workers, pool : number of processes to render with, or a running pool of them, see displays.generate_plots
+    """
+    specs = [dict(spec, out_dir=out_dir, fmt=fmt, cache_dir=render_cache_dir) for spec in plot_specs(calculation_kind, var_to_track, manifest=manifest)]
+
+    # load and slice the data once for all plots
+    data = as_frame(calculated)
+    data = data[required_columns(specs)]
+
+    outputs = [[path for path, _, _ in image_outputs(spec['name'], out_dir, fmt)] for spec in specs]
+    paths = [files[0] for files in outputs]
+    keys = [plot_key(data, spec) for spec in specs]
+
+    state = {}
+    if state_file is not None and os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+
+    todo = [i for i, (path, key) in enumerate(zip(paths, keys)) if state.get(path) != key or not all(os.path.exists(f) for f in outputs[i])]
+    print(f'Rendering {len(todo)} of {len(specs)} {calculation_kind} {var_to_track} plots ({len(specs) - len(todo)} unchanged).')
+    generate_plots(data, [specs[i] for i in todo], workers=workers, pool=pool)
+
+    if state_file is not None:
+        state.update({paths[i]: keys[i] for i in todo})
+        os.makedirs(os.path.dirname(state_file) or '.', exist_ok=True)
+        with open(state_file + '.tmp', 'w') as f:
+            json.dump(state, f, indent=1)
+        os.replace(state_file + '.tmp', state_file)
+
+    return paths
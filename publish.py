@@ -0,0 +1,163 @@
+"""
+Publish the outputs of main.py to the web directory.
+
+Every file is stored once in a content-addressed store inside the web directory (`.store/`, named by the sha1 of its content) and appears elsewhere only as hardlinks to it:
+
+    {root}/{name}                data/* (the csv/npz/json tables), replaced file by file
+    {root}/{dd-mm-yyyy}/{name}   images/* of the day
+    {root}/today -> .today-...   images/* of this run; a symlink swapped by a single rename
+
+A file whose content did not change since it was last published keeps its store object and links, so the disk grows only by what changed. Every link is made under a temporary name and renamed into place, so readers never see a partial file, and `today` switches from one complete set of images to the next.
+
+    python3 publish.py /web/www/data/covid-19
+
+`.store/` and the `.today-*` snapshots have to sit inside the web directory (hardlinks need the same filesystem, and `today` is a relative symlink), but they are not meant to be browsed: their files are served only under the names above. The web server should refuse URLs of dot-directories, e.g.
+
+    Apache:  RedirectMatch 404 /\.(store|today-)
+    nginx:   location ~ /\.(store|today-) { return 404; }
+
+Requests to `today/...` are not affected, since the symlink is resolved on the filesystem, after the URL is matched.
+"""
+
+import os, re, time, json, shutil, datetime, argparse
+from storage import file_signature
+
+store_name = '.store' # content-addressed store, inside the web directory so that it is on the same filesystem as the links
+today_name = 'today'
+dated_format = '%d-%m-%Y' # name of the directory of each day's images
+state_file = os.path.join('cache', 'publish_state.json') # size, mtime and hash of each published file, so that unchanged files are not hashed again
+
+def store_object(path, digest, store_dir):
+    """Path of the store object holding the content of `path`, copied in if not stored yet; return (object path, whether it was new)
+
+    The object is a copy rather than a link to `path`, since the pipeline rewrites its outputs in place.
+    """
+    obj = os.path.join(store_dir, digest[:2], digest[2:] + os.path.splitext(path)[1])
+    if os.path.exists(obj):
+        return obj, False
+    os.makedirs(os.path.dirname(obj), exist_ok=True)
+    shutil.copyfile(path, obj + '.tmp')
+    os.chmod(obj + '.tmp', 0o644)
+    os.replace(obj + '.tmp', obj)
+    return obj, True
+
+def link(obj, dest):
+    """Make dest a hardlink to a store object, atomically; return False if it already was one
+    """
+    try:
+        if os.path.samefile(obj, dest):
+            return False
+    except FileNotFoundError:
+        pass
+    tmp = os.path.join(os.path.dirname(dest), f'.{os.path.basename(dest)}.tmp')
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.link(obj, tmp)
+    os.replace(tmp, dest)
+    return True
+
+def swap_symlink(target, dest):
+    """Point the symlink dest at target with a single rename
+    """
+    tmp = dest + '.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(target, tmp)
+    if os.path.isdir(dest) and not os.path.islink(dest): # a directory from before publishing used links; moved aside once
+        os.replace(dest, os.path.join(os.path.dirname(dest), f'.{os.path.basename(dest)}-old'))
+    os.replace(tmp, dest)
+
+def collect_garbage(store_dir):
+    """Remove store objects that are no longer linked from anywhere; return how many were removed
+    """
+    removed = 0
+    for dirpath, _, filenames in os.walk(store_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if os.stat(path).st_nlink == 1:
+                os.remove(path)
+                removed += 1
+    return removed
+
+def publish(root, data_dir='data', images_dir='images', date=None, state_file=state_file):
+    """Publish the tables of data_dir and the images of images_dir under root (see the layout at the top of this module) and return a summary
+
+    date : date of the dated image directory (default today)
+    state_file : optional json file with the signature of each published file
+    """
+    t0 = time.perf_counter()
+    date = date or datetime.date.today()
+    store_dir = os.path.join(root, store_name)
+
+    state = {}
+    if state_file is not None and os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+
+    summary = dict(files=0, new_objects=0, links=0, unchanged=0)
+    objects = {}
+    def obj_of(path):
+        if path not in objects:
+            state[path] = file_signature(path, state.get(path))
+            objects[path], new = store_object(path, state[path]['sha1'], store_dir)
+            summary['files'] += 1
+            summary['new_objects'] += new
+        return objects[path]
+    def link_all(paths, dest_dir):
+        os.makedirs(dest_dir, exist_ok=True)
+        for path in paths:
+            if link(obj_of(path), os.path.join(dest_dir, os.path.basename(path))):
+                summary['links'] += 1
+            else:
+                summary['unchanged'] += 1
+
+    def files(directory):
+        if not os.path.isdir(directory):
+            return []
+        return sorted(entry.path for entry in os.scandir(directory) if entry.is_file() and not entry.name.startswith('.'))
+    data, images = files(data_dir), files(images_dir)
+
+    # tables, in place
+    link_all(data, root)
+
+    # images of the day
+    link_all(images, os.path.join(root, date.strftime(dated_format)))
+
+    # today: a new directory of links, swapped in whole
+    snapshot = f'.{today_name}-{datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")}'
+    legacy = os.path.join(root, f'.{today_name}-old')
+    legacy_moved_before = os.path.isdir(legacy) # by the swap of an earlier run, so no longer read
+    link_all(images, os.path.join(root, snapshot))
+    swap_symlink(snapshot, os.path.join(root, today_name))
+    # the previous snapshot (or legacy directory) is kept for readers that resolved `today` just before the swap
+    pattern = re.compile(rf'\.{re.escape(today_name)}-\d{{8}}-\d{{6}}-\d{{6}}')
+    snapshots = sorted(entry.name for entry in os.scandir(root) if pattern.fullmatch(entry.name) and entry.is_dir(follow_symlinks=False))
+    for old in snapshots[:-2]:
+        shutil.rmtree(os.path.join(root, old))
+    if legacy_moved_before:
+        shutil.rmtree(legacy)
+
+    summary['removed_objects'] = collect_garbage(store_dir)
+
+    if state_file is not None:
+        state = {path: sig for path, sig in state.items() if path in objects}
+        os.makedirs(os.path.dirname(state_file) or '.', exist_ok=True)
+        with open(state_file + '.tmp', 'w') as f:
+            json.dump(state, f, indent=1)
+        os.replace(state_file + '.tmp', state_file)
+
+    summary['seconds'] = round(time.perf_counter() - t0, 3)
+    print(f'Published {summary["files"]} files to {root} in {summary["seconds"] * 1000:.0f} ms: {summary["new_objects"]} new in the store, {summary["links"]} links made, {summary["unchanged"]} unchanged, {summary["removed_objects"]} unused objects removed.')
+    return summary
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('root', help='web directory to publish to')
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--images-dir', default='images')
+    parser.add_argument('--date', type=datetime.date.fromisoformat, help='date of the dated image directory, as yyyy-mm-dd (default today)')
+    args = parser.parse_args(args)
+    return publish(args.root, data_dir=args.data_dir, images_dir=args.images_dir, date=args.date)
+
+if __name__ == '__main__':
+    main()
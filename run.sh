@@ -5,13 +5,8 @@ cd /web/covid-19
 git pull origin master
 git submodule foreach git pull origin master
 
-[ ! -d "/web/www/data/covid-19/$(date +"%d-%m-%Y")" ] && mkdir "/web/www/data/covid-19/$(date +"%d-%m-%Y")"
+# Run pipeline (scrapes once, then calculates and plots each variable/calculation pair)
+python3 main.py deaths confirmed doubling_time fold_change
 
-# Run pipeline
-python3 main.py deaths
-python3 main.py confirmed
-
-# copy output folders
-cp images/* "/web/www/data/covid-19/today"
-cp images/* "/web/www/data/covid-19/$(date +"%d-%m-%Y")"
-cp data/* "/web/www/data/covid-19/"
+# publish tables and images (hardlinks into a content-addressed store; "today" and each file are swapped in atomically)
+python3 publish.py "/web/www/data/covid-19"
@@ -4,7 +4,6 @@
 git pull origin master
 git submodule foreach git pull origin master
 
-# Run pipeline
-python3 main.py deaths
-python3 main.py confirmed
+# Run pipeline (scrapes once, then calculates and plots each variable/calculation pair)
+python3 main.py deaths confirmed doubling_time fold_change
 
@@ -1,7 +1,11 @@
-import sys, datetime, os
+import sys, datetime, os, io, json, functools
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 import csv
+import instrument
+from instrument import count
+from storage import OffsetTable, file_hash, file_signature
 
 ALL_STATES = ["Alabama","Alaska","Arizona","Arkansas","California","Colorado","Connecticut","Delaware","Florida","Georgia","Hawaii","Idaho","Illinois", "Indiana","Iowa","Kansas","Kentucky","Louisiana","Maine","Maryland","Massachusetts","Michigan","Minnesota","Mississippi","Missouri","Montana","Nebraska","Nevada","New Hampshire","New Jersey","New Mexico","New York","North Carolina","North Dakota","Ohio","Oklahoma","Oregon","Pennsylvania","Rhode Island","South Carolina","South Dakota","Tennessee","Texas","Utah","Vermont","Virginia","Washington","West Virginia","Wisconsin","Wyoming","DC"]
 ALL_COUNTRIES = ['Canada', 'US', 'China', 'Italy', 'Spain', 'South Korea', 'Australia', 'Germany', 'France', 'Japan', 'Iran', 'UK', 'World']
@@ -16,10 +20,39 @@ ALL_US_REGIONS = {'Pacific': ['Washington', 'Oregon', 'California'],
                   'Mid-Atlantic': ['Virginia', 'West Virginia', 'Maryland', 'Delaware', 'DC'], 
         }
 
+# JHU daily reports
+JHU_DAILY_TEMPLATE = "COVID-19/csse_covid_19_data/csse_covid_19_daily_reports/{datestr}.csv"
+JHU_VARIABLES = ['Deaths', 'Confirmed', 'Recovered']
+JHU_COLUMN_RENAME = {'Province/State': 'Province_State',
+                     'Country/Region': 'Country_Region'}
+JHU_VALUE_RELABEL = {'Mainland China': 'China',
+                     'Korea, South': 'South Korea',
+                     'Republic of Korea': 'South Korea',
+                     'Iran (Islamic Republic of)': 'Iran',
+                     'District of Columbia': 'DC',
+                     'United Kingdom': 'UK'}
+
+# JHU time series (one wide file per variable and scope, with a column per date)
+JHU_TS_TEMPLATE = "COVID-19/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_{var}_{scope}.csv"
+
+# NYT tables
+NYT_COLUMN_RENAME = {'deaths': 'Deaths',
+                     'cases': 'Confirmed',
+                    }
+NYT_VALUE_RELABEL = {
+                     'District of Columbia': 'DC',
+                     }
+NYT_VARIABLES = ['Deaths', 'Confirmed']
+NYT_USECOLS = ['date', 'state', 'county', 'cases', 'deaths'] # columns read from the NYT tables (when present)
+NYT_CHUNK_ROWS = 250000 # rows of us-counties.csv parsed at a time
+
 def scrape_regional_data(*args, **kwargs):
     source = kwargs.pop('source', 'jhu')
     if source == 'jhu':
         return scrape_regional_data_jhu(*args, **kwargs)
+    elif source == 'jhu_ts':
+        table = load_jhu_time_series(kwargs.get('var_to_track', 'Deaths'))
+        return scrape_regional_data_jhu(*args, table=table, **kwargs)
     elif source == 'nyt':
         return scrape_regional_data_nyt(*args, **kwargs)
 
@@ -27,7 +60,8 @@ def scrape_regional_data_jhu(region="new jersey",
                              region_type="state",
                              var_to_track="Deaths",
                              start_date=datetime.date(2020, 1, 25),
-                             data_src_template="COVID-19/csse_covid_19_data/csse_covid_19_daily_reports/{datestr}.csv"):
+                             data_src_template=JHU_DAILY_TEMPLATE,
+                             table=None):
 
     """Scrape data for a given region and store in local csv file
     
@@ -38,93 +72,710 @@ def scrape_regional_data_jhu(region="new jersey",
     var_to_track : e.g. "Deaths" / "Confirmed" / "Recovered"
     start_date : datetime date object, e.g. datetime.date(2020, 1, 1)
     data_src_template : str template for data source files
+    table : optional long table from load_jhu_daily_reports, to avoid re-reading the daily files
 
     Returns
     -------
     regional_data : pd Series with index of dates and values of var_to_track
     """
 
-    region_type_dict = {"state": "Province_State",
-                        "country": "Country_Region"}
+    if table is None:
+        table = load_jhu_daily_reports(start_date=start_date, data_src_template=data_src_template)
 
-    column_rename = {'Province/State': 'Province_State',
-                     'Country/Region': 'Country_Region'}
+    result = aggregate_jhu(table, {'region': region}, region_type=region_type, var_to_track=var_to_track, start_date=start_date)
+    return result['region'].rename(None)
 
-    value_relabel = {'Mainland China': 'China',
-                     'Korea, South': 'South Korea',
-                     'Republic of Korea': 'South Korea',
-                     'Iran (Islamic Republic of)': 'Iran',
-                     'District of Columbia': 'DC',
-                     'United Kingdom': 'UK'}
+def read_jhu_daily_report(data_src):
+    """Read a single JHU daily report and normalize it to a common schema
 
-    if not isinstance(region, list):
-        region = [region]
+    All historical column schemas (`Province/State` vs `Province_State` etc.) and region spellings (`JHU_VALUE_RELABEL`) are mapped onto one naming, and rows are summed per (country, state) so that county-level rows in later reports collapse to their state.
 
-    region = [r.lower() for r in region]
-    region_type = region_type.lower()
-    region_type = region_type_dict[region_type]
+    Returns
+    -------
+    DataFrame with columns country, state, and each of JHU_VARIABLES
+    """
+
+    # open data file
+    data = pd.read_csv(data_src)
+    count('files_read')
+    count('rows_parsed', len(data))
+
+    # clean up
+    data.rename(JHU_COLUMN_RENAME, axis=1, inplace=True)
+    data = data.rename({'Country_Region': 'country', 'Province_State': 'state'}, axis=1)
+    for col in ['country', 'state']:
+        data[col] = data[col].replace(JHU_VALUE_RELABEL).fillna('')
+    for var in JHU_VARIABLES:
+        if var not in data.columns:
+            data[var] = np.nan
+
+    return data.groupby(['country', 'state'], as_index=False, sort=False)[JHU_VARIABLES].sum()
+
+def load_jhu_daily_reports(start_date=datetime.date(2020, 1, 25),
+                           end_date=None,
+                           data_src_template=JHU_DAILY_TEMPLATE,
+                           cache_dir=None,
+                           workers=None,
+                           memory=None):
+    """Read every JHU daily report once and stack them into one long table
+
+    Parameters
+    ----------
+    start_date : first date to read
+    end_date : day after the last date to read, defaults to today
+    data_src_template : str template for data source files
+    cache_dir : optional directory in which to persist the normalized per-day tables; on later calls only daily files that are new or whose content changed (e.g. back-filled revisions) are parsed again
+    workers : number of processes that read and normalize the files; None uses all cores, 1 reads them sequentially in this process. Results are merged in date order, identical to the sequential read.
+    memory : optional dict in which a long-running process holds the cached tables between calls, see _read_cache
 
-    end_date = datetime.date.today()
-    time_delta = end_date - start_date
-    n_days = time_delta.days
+    Returns
+    -------
+    DataFrame with columns date, country, state, and each of JHU_VARIABLES
+    """
 
-    # grab and calculate totals for given region    
-    dates = np.zeros(n_days, dtype='datetime64[s]')
-    totals = np.zeros(n_days)
+    index, cached = {}, None
+    if cache_dir is not None:
+        index, cached = _read_cache(cache_dir, 'jhu_daily', memory)
+    cached_by_date = dict(tuple(cached.groupby('date'))) if cached is not None else {}
 
-    for day in range(n_days):
-        # specify day of interest and relevant data file
-        date = start_date + datetime.timedelta(days=day)
+    dates = _date_range(start_date, end_date)
+    frames = [] # per date, a cached table or the path of a file to parse
+    new_index = dict(index)
+    n_new, n_changed = 0, 0
+    for date in dates:
         datestr = date.strftime('%m-%d-%Y')
         data_src = data_src_template.format(datestr=datestr)
 
-        # open data file
-        data = pd.read_csv(data_src)
-
-        # clean up
-        data.rename(column_rename, axis=1, inplace=True)
-        data.replace(value_relabel, inplace=True)
-
-        # collect only rows from region of interest
-        is_region = data[region_type].str.lower().isin(region)
-        rows = data[is_region]
-        if 'world' in region:
-            rows = data
-            #rows = data[data['Country_Region'].str.lower() != 'china']
-
-        # collect values of relevant variable (e.g. deaths)
-        values = rows[var_to_track].values
-        total = np.nansum(values)
-
-        # store values
-        dates[day] = np.datetime64(date)
-        totals[day] = total
-
-    # correct for any errors where day n+1 has less than day n
-    dif = np.append(0, np.diff(totals))
-    while np.any(dif < 0):
-        i_issue = np.argwhere(dif < 0)[:,0]
-        for i in i_issue:
-            totals[i] = totals[i-1]
-        dif = np.append(0, np.diff(totals))
-    assert np.all(np.diff(totals) >= 0), 'Non monotonic cumulative values'
-
-    result = pd.Series(totals, index=dates)
+        if cache_dir is not None:
+            previous = index.get(datestr)
+            new_index[datestr] = sig = file_signature(data_src, previous)
+            if previous is not None and cached is not None and sig['sha1'] == previous['sha1']:
+                if pd.Timestamp(date) in cached_by_date:
+                    frames.append(cached_by_date[pd.Timestamp(date)])
+                continue
+            if previous is None:
+                n_new += 1
+            else:
+                n_changed += 1
+
+        frames.append((data_src, date))
+
+    # parse the files that are not cached, in parallel, keeping their place among the cached tables
+    todo = [i for i, frame in enumerate(frames) if isinstance(frame, tuple)]
+    for i, data in zip(todo, _read_jhu_daily_reports([frames[i] for i in todo], workers=workers)):
+        frames[i] = data
+
+    table = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['date', 'country', 'state'] + JHU_VARIABLES)
+
+    if cache_dir is not None:
+        print(f'\tJHU daily reports: {n_new} new, {n_changed} changed, {len(dates) - n_new - n_changed} from cache.')
+        if new_index != index:
+            # keep cached days outside of the requested range
+            if cached is not None:
+                table_dates = set(table['date'])
+                outside = cached[~cached['date'].isin(table_dates)]
+                _write_cache(cache_dir, 'jhu_daily', new_index, pd.concat([outside, table], ignore_index=True), memory)
+            else:
+                _write_cache(cache_dir, 'jhu_daily', new_index, table, memory)
+
+    return table
+
+def _read_jhu_daily_reports(files, workers=None):
+    """Read and normalize (data source, date) daily reports with a pool of processes, returning the tables in the order of `files`
+
+    On a malformed file, the files not yet started are cancelled and a ValueError naming the file is raised.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(files))
+
+    if workers <= 1:
+        return [_read_jhu_daily_dated(data_src, date) for data_src, date in files]
+
+    # files are handed out in small batches: few enough to limit the overhead per file, small enough that little work is left in flight after an error
+    size = max(1, min(32, len(files) // (4 * workers)))
+    batches = [files[i:i + size] for i in range(0, len(files), size)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_read_jhu_daily_worker, batch) for batch in batches]
+        try:
+            results = [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    # counters of the workers are reported in this process
+    tables = []
+    for batch_tables, counters in results:
+        tables.extend(batch_tables)
+        for name, n in counters.items():
+            count(name, n)
+    return tables
+
+def _read_jhu_daily_dated(data_src, date):
+    try:
+        data = read_jhu_daily_report(data_src)
+    except Exception as e:
+        raise ValueError(f'Could not read JHU daily report {data_src}: {e!r}') from e
+    data.insert(0, 'date', pd.Timestamp(date))
+    return data
+
+def _read_jhu_daily_worker(files):
+    before = dict(instrument.counters)
+    tables = [_read_jhu_daily_dated(data_src, date) for data_src, date in files]
+    return tables, {k: v - before.get(k, 0) for k, v in instrument.counters.items() if v != before.get(k, 0)}
+
+def load_jhu_time_series(var_to_track="Deaths", data_src_template=JHU_TS_TEMPLATE):
+    """Read the JHU wide time series files into the same long table as load_jhu_daily_reports
+
+    Global files provide every country; US files break the US down by state (and county), and replace the single US row of the global files so that nothing is counted twice. Four file reads in total for deaths and confirmed, instead of one per day.
+
+    Parameters
+    ----------
+    var_to_track : variable or list of variables, e.g. ["Deaths", "Confirmed"]
+    data_src_template : str template for data source files, with {var} and {scope} ("global" / "US")
+
+    Returns
+    -------
+    DataFrame with columns date, country, state, and each requested variable
+    """
+    variables = var_to_track if isinstance(var_to_track, list) else [var_to_track]
+
+    series = []
+    for var in variables:
+        frames = []
+        for scope in ['global', 'US']:
+            data = pd.read_csv(data_src_template.format(var=var.lower(), scope=scope))
+            count('files_read')
+            count('rows_parsed', len(data))
+
+            # clean up, as for daily reports
+            data.rename(JHU_COLUMN_RENAME, axis=1, inplace=True)
+            data = data.rename({'Country_Region': 'country', 'Province_State': 'state'}, axis=1)
+            for col in ['country', 'state']:
+                data[col] = data[col].replace(JHU_VALUE_RELABEL).fillna('')
+            if scope == 'global':
+                data = data[data['country'] != 'US']
+
+            # wide to long: one row per (date, country, state)
+            dates = pd.to_datetime(pd.Series(data.columns), format='%m/%d/%y', errors='coerce')
+            date_cols = data.columns[dates.notna().values]
+            long = data.melt(id_vars=['country', 'state'], value_vars=list(date_cols), var_name='date', value_name=var)
+            long['date'] = pd.to_datetime(long['date'], format='%m/%d/%y')
+            frames.append(long)
+
+        long = pd.concat(frames, ignore_index=True)
+        series.append(long.groupby(['date', 'country', 'state'], sort=False)[var].sum())
+
+    return pd.concat(series, axis=1).reset_index()
+
+def compare_jhu_sources(var_to_track="Deaths", **kw):
+    """Consistency check between the daily-report ("jhu") and time series ("jhu_ts") sources
+
+    Remaining keyword arguments are passed to scrape_all_regions for both sources.
+
+    Returns
+    -------
+    DataFrame with one row per region: number of days on which the sources differ, largest absolute difference, and both latest values
+    """
+    daily = scrape_all_regions(source='jhu', var_to_track=var_to_track, **kw)
+    ts = scrape_all_regions(source='jhu_ts', var_to_track=var_to_track, **kw)
+    dif = (daily - ts).abs()
+    return pd.DataFrame({'days_differing': (dif > 0).sum(),
+                         'max_abs_diff': dif.max(),
+                         'last_daily': daily.iloc[-1],
+                         'last_ts': ts.iloc[-1]})
+
+def aggregate_jhu(table, regions, region_type="state", var_to_track="Deaths", start_date=datetime.date(2020, 1, 25), end_date=None, corrections=None):
+    """Sum a long JHU table into one cumulative series per region
+
+    Parameters
+    ----------
+    table : long table from load_jhu_daily_reports
+    regions : dict of output name -> region name or list of region names (e.g. a state grouping); "world" sums every row
+    region_type : "state" or "country"
+    corrections : optional list to which the cells changed by correct_monotonic are appended
+
+    Returns
+    -------
+    DataFrame with index of dates and one column per entry in `regions`
+    """
+
+    region_type = region_type.lower()
+    region_type = {"state": "state", "country": "country"}[region_type]
+    dates = pd.DatetimeIndex([pd.Timestamp(d) for d in _date_range(start_date, end_date)])
+
+    # one groupby for all regions: date x region totals
+    keys = table[region_type].str.lower()
+    totals = table.groupby([table['date'], keys])[var_to_track].sum().unstack(fill_value=0)
+    totals = totals.reindex(index=dates, fill_value=0)
+    world = table.groupby('date')[var_to_track].sum().reindex(dates, fill_value=0)
+
+    return _aggregate_regions(totals, regions, world=world, corrections=corrections)
+
+def _aggregate_regions(totals, regions, world=None, corrections=None):
+    """Sum the columns of a date x region totals matrix into the requested regions and correct each to be cumulative
+
+    totals : DataFrame with index of dates and lowercase region keys as columns
+    regions : dict of output name -> region key or list of keys; None sums every column, as does "world" when `world` is not given
+    world : optional series to use for the "world" region
+    corrections : optional list to which the cells changed by correct_monotonic are appended, as a DataFrame
+
+    All regions are summed in one product of the totals with the region x key membership matrix (see membership_matrix), so a grouping costs one row of that matrix.
+    """
+    indptr, indices, is_world = membership_matrix(regions, totals.columns)
+
+    # sparse product: each region sums the columns listed in its row of the matrix
+    values = totals.values[:, indices].astype(float)
+    result = np.zeros((len(totals), len(regions)))
+    nonempty = indptr[:-1] < indptr[1:]
+    if nonempty.any():
+        result[:, nonempty] = np.add.reduceat(values, indptr[:-1][nonempty], axis=1)
+    if world is not None:
+        result[:, is_world] = np.asarray(world, dtype=float)[:, None]
+
+    result, corrected = correct_monotonic(pd.DataFrame(result, index=totals.index, columns=list(regions)))
+    if corrections is not None:
+        corrections.append(corrected)
     return result
 
-def get_counties_nyt(state, data_dir='covid-19-data'):
-    
-    value_relabel = {
-                     'District of Columbia': 'DC',
-                     }
+def _aggregate_observations(observations, var_to_track, dates, regions, corrections=None):
+    """Sum per date and key observations into the requested regions over `dates` and correct each to be cumulative, as _aggregate_regions does for a dense totals matrix
 
-    data_src = os.path.join(data_dir, 'us-counties.csv')
-    data = pd.read_csv(data_src)
+    observations : as returned by load_nyt_totals
+    regions : dict of output name -> key or list of keys, see membership_matrix
+
+    The counts of every key are laid out as an OffsetTable first; a region of a single key is that column, and only the regions summing several keys (e.g. metro areas) are summed, a block of columns at a time.
+
+    Returns
+    -------
+    OffsetTable, each region stored from its first nonzero count
+    """
+    keys = observations['key'].cat.categories
+    rows = dates.get_indexer(observations['date'].cat.categories)[observations['date'].cat.codes.values]
+    values = observations[var_to_track].values
+    inside = (rows >= 0) & (values != 0)
+    counts = OffsetTable.from_observations(dates, keys, rows[inside], observations['key'].cat.codes.values[inside], values[inside])
+    del rows, inside
+
+    indptr, indices, _ = membership_matrix(regions, keys)
+    single = np.diff(indptr) == 1
+    parts, order = [], []
+    if single.any():
+        parts.append(counts.take(indices[indptr[:-1][single]]))
+        order.extend(np.flatnonzero(single))
+    if not single.all():
+        summed = np.zeros((len(dates), int((~single).sum())))
+        members = [indices[indptr[i]:indptr[i + 1]] for i in np.flatnonzero(~single)]
+        for block in counts.column_blocks():
+            values = counts.dense(block)
+            for r, member in enumerate(members):
+                member = member[(member >= block.start) & (member < block.stop)] - block.start
+                if len(member):
+                    summed[:, r] += values[:, member].sum(axis=1)
+        parts.append(OffsetTable.from_dense(summed, dates, np.arange(len(members)), dtype=np.float32 if np.abs(summed).max(initial=0) < 2**24 else float))
+        order.extend(np.flatnonzero(~single))
+    table = OffsetTable.concat(parts).take(np.argsort(order))
+    table.columns = pd.Index(list(regions))
+
+    table, corrected = correct_monotonic(table)
+    if corrections is not None:
+        corrections.append(corrected)
+    return table
+
+def membership_matrix(regions, keys):
+    """Region x key membership matrix of a set of regions, in compressed sparse row form
+
+    Parameters
+    ----------
+    regions : dict of output name -> key or list of keys; None or "world" stands for every key
+    keys : lowercase region keys, e.g. the columns of a date x region totals matrix; keys not among them are ignored
+
+    Returns
+    -------
+    indptr, indices : the keys of the i-th region are keys[indices[indptr[i]:indptr[i + 1]]]
+    is_world : boolean array marking the regions that stand for every key
+    """
+    position = {key: i for i, key in enumerate(keys)}
+    indptr, indices, is_world = [0], [], []
+    for members in regions.values():
+        if members is None:
+            members = ['world']
+        if not isinstance(members, list):
+            members = [members]
+        members = [m.lower() for m in members]
+        is_world.append('world' in members)
+        if is_world[-1]:
+            indices.extend(range(len(position)))
+        else:
+            indices.extend(position[m] for m in members if m in position)
+        indptr.append(len(indices))
+    return np.array(indptr), np.array(indices, dtype=int), np.array(is_world, dtype=bool)
+
+def load_groupings(filename):
+    """Read user-defined region groupings from a json config file
+
+    The file maps a region type to groupings of that type, each a name and a list of member regions, e.g.
+        {"state": {"Great Lakes": ["Michigan", "Ohio", ...]},
+         "county": {"New York City metro": ["New York:New York City", "New Jersey:Hudson", ...]}}
+    County members are "state:county" (case-insensitive, as in nyt_keys).
+
+    Returns
+    -------
+    dict of region type -> dict of grouping name -> list of members, to be passed as `groupings` to scrape_all_regions ("state") and scrape_all_counties ("county")
+    """
+    with open(filename) as f:
+        groupings = json.load(f)
+    for region_type, groups in groupings.items():
+        assert region_type in ('state', 'county'), f'Unknown region type in {filename}: {region_type}'
+        for name, members in groups.items():
+            assert isinstance(members, list), f'Members of {name} in {filename} should be a list'
+    return groupings
+
+def _is_appended(path, previous):
+    """True if the file at `path` is the file described by `previous` with rows appended
+    """
+    if previous is None or os.path.getsize(path) <= previous['size']:
+        return False
+    with open(path, 'rb') as f:
+        f.seek(previous['size'] - 1)
+        if f.read(1) != b'\n':
+            return False
+    return file_hash(path, previous['size']) == previous['sha1']
+
+def _read_cache(cache_dir, name, memory=None):
+    """Load the signature index and table of a scrape cache entry, or ({}, None) if absent
+
+    memory : optional dict in which a long-running process (see main.run) holds the entries it loaded or wrote; an entry whose files did not change since is not read again. Callers get a copy, which they may modify.
+    """
+    index_path = os.path.join(cache_dir, f'{name}.json')
+    table_path = os.path.join(cache_dir, f'{name}.pkl')
+    if not (os.path.exists(index_path) and os.path.exists(table_path)):
+        return {}, None
+    sig = _cache_signature(index_path, table_path)
+    if memory is None or table_path not in memory or memory[table_path][0] != sig:
+        with open(index_path) as f:
+            index = json.load(f)
+        table = pd.read_pickle(table_path)
+        if memory is None:
+            return index, table
+        memory[table_path] = (sig, index, table)
+    _, index, table = memory[table_path]
+    return dict(index), table.copy()
+
+def _write_cache(cache_dir, name, index, table, memory=None):
+    """Persist the table and then the signature index of a scrape cache entry, each replaced atomically
+
+    memory : as in _read_cache; a copy of the entry is kept there
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    index_path = os.path.join(cache_dir, f'{name}.json')
+    table_path = os.path.join(cache_dir, f'{name}.pkl')
+    table.to_pickle(table_path + '.tmp')
+    os.replace(table_path + '.tmp', table_path)
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(index_path + '.tmp', index_path)
+    if memory is not None:
+        memory[table_path] = (_cache_signature(index_path, table_path), dict(index), table.copy())
+
+def _cache_signature(*paths):
+    """mtime and size of the files of a scrape cache entry, which change whenever it is rewritten
+    """
+    return tuple((stat.st_mtime_ns, stat.st_size) for stat in map(os.stat, paths))
+
+def _date_range(start_date, end_date=None):
+    """Dates from start_date up to, not including, end_date (default today)
+    """
+    if end_date is None:
+        end_date = datetime.date.today()
+    n_days = (end_date - start_date).days
+    return [start_date + datetime.timedelta(days=day) for day in range(n_days)]
+
+def correct_monotonic(data):
+    """Correct for any errors where day n+1 has less than day n, in all columns of a date x region matrix at once
+
+    Each value is raised to the running maximum of its column, i.e. a drop is held at the last high value until the series exceeds it again.
+
+    Parameters
+    ----------
+    data : DataFrame (or array) with dates along the rows, or an OffsetTable, which is corrected a block of columns at a time
+
+    Returns
+    -------
+    corrected : data with non-decreasing columns
+    corrections : DataFrame with one row per corrected cell: date, region, reported and corrected value
+    """
+    if isinstance(data, OffsetTable):
+        blocks, cells = [], []
+        for columns in data.column_blocks():
+            corrected, corrections = correct_monotonic(data.block_frame(columns))
+            blocks.append(OffsetTable.from_dense(corrected.values, data.index, corrected.columns, dtype=data.values.dtype))
+            cells.append(corrections)
+        corrections = pd.concat(cells, ignore_index=True)
+        # ordered by date, then region, as for a whole DataFrame
+        order = np.lexsort((data.columns.get_indexer(corrections['region']), data.index.get_indexer(corrections['date'])))
+        return OffsetTable.concat(blocks), corrections.iloc[order].reset_index(drop=True)
+
+    values = np.asarray(data, dtype=float)
+    values = values.reshape(len(values), -1) # series as a single column
+    corrected = np.maximum.accumulate(values, axis=0)
+    assert np.all(np.diff(corrected, axis=0) >= 0), 'Non monotonic cumulative values'
+
+    rows, cols = np.nonzero(corrected != values)
+    index = data.index if isinstance(data, (pd.DataFrame, pd.Series)) else pd.RangeIndex(len(values))
+    columns = data.columns if isinstance(data, pd.DataFrame) else pd.Index([getattr(data, 'name', None)] * values.shape[1])
+    corrections = pd.DataFrame({'date': index[rows],
+                                'region': columns[cols],
+                                'reported': values[rows, cols],
+                                'corrected': corrected[rows, cols]})
+
+    corrected = corrected.reshape(np.shape(data))
+    if isinstance(data, pd.DataFrame):
+        corrected = pd.DataFrame(corrected, index=data.index, columns=data.columns)
+    elif isinstance(data, pd.Series):
+        corrected = pd.Series(corrected, index=data.index, name=data.name)
+    return corrected, corrections
+
+def load_nyt(region_type="state", data_dir="covid-19-data", data_src=None, cache_dir=None, memory=None):
+    """Read and clean one of the NYT data tables
+
+    region_type : "state" (us-states.csv), "county" (us-counties.csv), or anything else with an explicit data_src (e.g. us.csv)
+    cache_dir : optional directory in which to persist the cleaned table; on later calls an unchanged file is not parsed at all, and a file that only had rows appended has just the new rows parsed
+    memory : optional dict in which a long-running process holds the cached tables between calls, see _read_cache
+
+    The county table, by far the largest, is read in chunks and held compactly (see _read_nyt_chunks). To sum it into date x county totals, load_nyt_totals does not hold the table at all.
+    """
+
+    if region_type == 'state':
+        data_src = os.path.join(data_dir, 'us-states.csv')
+    elif region_type == 'county':
+        data_src = os.path.join(data_dir, 'us-counties.csv')
+    else:
+        assert data_src is not None, 'Without region specified, data src must be explicitly provided.'
+
+    read = lambda offset=0: _read_nyt(data_src, offset=offset, compact=region_type == 'county')
+    def append(cached, offset):
+        appended = read(offset=offset)
+        print(f'\t{os.path.basename(data_src)}: {len(appended)} appended rows.')
+        return _concat_nyt(cached, appended)
+
+    name = 'nyt-' + os.path.splitext(os.path.basename(data_src))[0]
+    return _load_cached(data_src, cache_dir, name, read, append, memory)
+
+def load_nyt_totals(region_type="county", data_dir="covid-19-data", cache_dir=None, chunksize=NYT_CHUNK_ROWS, memory=None):
+    """Stream us-counties.csv (or us-states.csv) into per date and region totals of each of NYT_VARIABLES, one chunk of rows at a time
+
+    Each chunk is summed into the totals as soon as it is parsed, so memory is bounded by the chunk size and the number of observations, not by the size of the file (nor by dates x regions).
+
+    cache_dir : as in load_nyt; only rows appended to the file since the totals were cached are streamed
+    memory : as in load_nyt
+
+    Returns
+    -------
+    DataFrame with one row per date and key with a nonzero total (see _accumulate_nyt), keys as in nyt_keys and in order of first appearance in the file
+    """
+    data_src = os.path.join(data_dir, {'county': 'us-counties.csv', 'state': 'us-states.csv'}[region_type])
+    read = lambda: _accumulate_nyt(_read_nyt_chunks(data_src, chunksize=chunksize), region_type)
+    def append(cached, offset):
+        print(f'\t{os.path.basename(data_src)}: adding appended rows to cached totals.')
+        return _accumulate_nyt(_read_nyt_chunks(data_src, offset=offset, chunksize=chunksize), region_type, totals=cached)
+
+    name = 'nyt-' + os.path.splitext(os.path.basename(data_src))[0] + '-observations'
+    return _load_cached(data_src, cache_dir, name, read, append, memory)
+
+def _load_cached(data_src, cache_dir, name, read, append, memory=None):
+    """Result of read() for a source file, through the scrape cache entry `name`
+
+    An unchanged file is not read at all, and for a file that only had rows appended the result is append(cached result, byte offset of the first new row).
+    """
+    if cache_dir is None:
+        return read()
+
+    index, cached = _read_cache(cache_dir, name, memory)
+    previous = index.get(data_src)
+    sig = file_signature(data_src, previous)
+    if cached is not None and previous is not None and sig['sha1'] == previous['sha1']:
+        data = cached
+    elif cached is not None and _is_appended(data_src, previous):
+        data = append(cached, previous['size'])
+    else:
+        data = read()
+
+    if sig != previous:
+        _write_cache(cache_dir, name, {data_src: sig}, data, memory)
+
+    return data
+
+def _read_nyt(data_src, offset=0, compact=False):
+    """Parse an NYT csv, or only its rows from byte `offset` onwards, optionally in chunks into the compact form of _read_nyt_chunks
+    """
+    if compact:
+        return functools.reduce(_concat_nyt, _read_nyt_chunks(data_src, offset=offset))
+
+    if offset:
+        with open(data_src, 'rb') as f:
+            header = f.readline()
+            f.seek(offset)
+            data = pd.read_csv(io.BytesIO(header + f.read()), usecols=lambda col: col in NYT_USECOLS)
+    else:
+        data = pd.read_csv(data_src, usecols=lambda col: col in NYT_USECOLS)
+    count('files_read')
+    count('rows_parsed', len(data))
 
     # clean up
-    data.replace(value_relabel, inplace=True)
+    data.rename(NYT_COLUMN_RENAME, axis=1, inplace=True)
+    data.replace(NYT_VALUE_RELABEL, inplace=True)
+
+    return data
+
+def _read_nyt_chunks(data_src, offset=0, chunksize=NYT_CHUNK_ROWS):
+    """Parse an NYT csv, or only its rows from byte `offset` onwards, in chunks of rows
 
-    counties = data[data.state.str.lower() == state].county.str.lower().unique()
+    Only NYT_USECOLS are parsed, with fixed dtypes: the text columns (date, state, county) as categoricals and the counts as float32, so memory scales with the number of rows at a few bytes per field. float32 holds integer counts exactly up to 2**24, which county counts stay well below.
+
+    Yields
+    ------
+    cleaned DataFrame for each chunk of rows
+    """
+    with open(data_src, 'rb') as f:
+        columns = f.readline().decode().strip().split(',')
+        if offset:
+            f.seek(offset)
+        count('files_read')
+        dtype = {'date': 'category', 'state': 'category', 'county': 'category', 'cases': np.float32, 'deaths': np.float32}
+        usecols = [col for col in columns if col in NYT_USECOLS]
+        for chunk in pd.read_csv(f, header=None, names=columns, usecols=usecols, dtype={col: dtype[col] for col in usecols}, chunksize=chunksize):
+            count('rows_parsed', len(chunk))
+
+            # clean up (relabelling the categories rather than every row)
+            chunk.rename(NYT_COLUMN_RENAME, axis=1, inplace=True)
+            for col in ['state', 'county']:
+                if col in chunk.columns:
+                    chunk[col] = chunk[col].map(lambda value: NYT_VALUE_RELABEL.get(value, value)).astype('category')
+            yield chunk
+
+def _accumulate_nyt(chunks, region_type="county", totals=None):
+    """Sum chunks of an NYT table into per date and key totals of each of NYT_VARIABLES
+
+    Each chunk is summed on its own (by bincount over its date and key codes) and only its nonzero sums are kept, so memory scales with the number of (date, key) observations, not with dates x keys.
+
+    totals : optional result of an earlier call, which the chunks are added to
+
+    Returns
+    -------
+    DataFrame with one row per date and key with a nonzero total in a chunk (a date and key whose rows span two chunks has a row for each, which add up): date and key as categoricals (keys as in nyt_keys, in order of first appearance) and each of NYT_VARIABLES as float32, exact for counts below 2**24
+    """
+    n_vars = len(NYT_VARIABLES)
+    dates, keys = {}, {} # label -> position in the categories
+    parts = [] # date codes, key codes and sums of the observations of each chunk
+    if totals is not None:
+        dates = {date: i for i, date in enumerate(totals['date'].cat.categories)}
+        keys = {key: i for i, key in enumerate(totals['key'].cat.categories)}
+        parts.append((totals['date'].cat.codes.values, totals['key'].cat.codes.values, totals[NYT_VARIABLES].values))
+
+    def positions(labels, known):
+        for label in labels:
+            known.setdefault(label, len(known))
+        return np.array([known[label] for label in labels], dtype=np.int32)
+
+    for chunk in chunks:
+        date_codes, date_labels = pd.factorize(chunk['date'])
+        key_codes, key_labels = pd.factorize(nyt_keys(chunk, region_type))
+        valid = (date_codes >= 0) & (key_codes >= 0)
+        rows = positions(pd.to_datetime(np.asarray(date_labels)), dates)
+        cols = positions(np.asarray(key_labels, dtype=object), keys)
+
+        n_keys = len(key_labels)
+        flat = date_codes[valid] * n_keys + key_codes[valid]
+        sums = np.empty((len(date_labels) * n_keys, n_vars), dtype=np.float32)
+        for v, var in enumerate(NYT_VARIABLES):
+            weights = np.nan_to_num(chunk[var].values[valid].astype(float)) # missing counts add nothing, as in a groupby sum
+            sums[:, v] = np.bincount(flat, weights=weights, minlength=len(date_labels) * n_keys)
+        observed = np.flatnonzero(sums.any(axis=1))
+        parts.append((rows[observed // n_keys], cols[observed % n_keys], sums[observed]))
+
+    if not parts:
+        parts = [(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros((0, n_vars), dtype=np.float32))]
+    data = {'date': pd.Categorical.from_codes(np.concatenate([part[0] for part in parts]), categories=pd.DatetimeIndex(list(dates))),
+            'key': pd.Categorical.from_codes(np.concatenate([part[1] for part in parts]), categories=list(keys))}
+    for v, var in enumerate(NYT_VARIABLES):
+        data[var] = np.concatenate([part[2][:, v] for part in parts])
+    return pd.DataFrame(data)
+
+def _concat_nyt(data, appended):
+    """Append rows to an NYT table; categorical columns are given the union of both categories first, so that they stay categorical
+    """
+    for col in appended.columns:
+        if isinstance(appended[col].dtype, pd.CategoricalDtype):
+            if not isinstance(data[col].dtype, pd.CategoricalDtype): # e.g. a table cached before compaction
+                data[col] = data[col].astype('category')
+            categories = data[col].cat.categories.union(appended[col].cat.categories)
+            data[col] = data[col].cat.set_categories(categories)
+            appended[col] = appended[col].cat.set_categories(categories)
+    return pd.concat([data, appended], ignore_index=True)
+
+def nyt_keys(data, region_type="state"):
+    """Lowercase region key of each row of an NYT table: "state", "state:county", or "" for national tables
+
+    Keys are returned as a categorical, built from the distinct (state, county) pairs, so no string is made per row. Rows missing a state or county have no key.
+    """
+    if region_type == 'state':
+        parts = [data['state']]
+    elif region_type == 'county':
+        parts = [data['state'], data['county']]
+    else:
+        return pd.Series('', index=data.index)
+
+    # code of each row's combination of parts, and the distinct combinations
+    codes, labels = zip(*[pd.factorize(part) for part in parts])
+    combined = np.zeros(len(data), dtype=np.int64)
+    for code, label in zip(codes, labels):
+        combined = combined * len(label) + code
+    valid = np.all([code >= 0 for code in codes], axis=0)
+    distinct, inverse = np.unique(combined[valid], return_inverse=True)
+
+    # key of each distinct combination (merging combinations that differ only in case)
+    names = []
+    for c in distinct:
+        name = []
+        for label in reversed(labels):
+            c, i = divmod(c, len(label))
+            name.insert(0, str(label[i]).lower())
+        names.append(':'.join(name))
+    key_codes, keys = pd.factorize(np.array(names, dtype=object))
+
+    row_codes = np.full(len(data), -1)
+    row_codes[valid] = key_codes[inverse.ravel()]
+    return pd.Series(pd.Categorical.from_codes(row_codes, categories=keys), index=data.index)
+
+def pivot_nyt(data, region_type="state", var_to_track="Deaths", start_date=datetime.date(2020, 1, 25), end_date=None):
+    """Pivot an NYT table into a date x region matrix of raw totals
+
+    Rows are reindexed over the full date range with zero fill; columns are the keys from nyt_keys. Rows are summed into the matrix by their (date, key) codes, without an intermediate long index.
+    """
+    dates = pd.DatetimeIndex([pd.Timestamp(d) for d in _date_range(start_date, end_date)])
+    date_codes, date_labels = pd.factorize(data['date'])
+    key_codes, key_labels = pd.factorize(nyt_keys(data, region_type))
+    valid = (date_codes >= 0) & (key_codes >= 0)
+    values = np.nan_to_num(data[var_to_track].values.astype(float)) # missing counts add nothing, as in a groupby sum
+
+    n_keys = len(key_labels)
+    totals = np.bincount(date_codes[valid] * n_keys + key_codes[valid], weights=values[valid], minlength=len(date_labels) * n_keys)
+    totals = pd.DataFrame(totals.reshape(len(date_labels), n_keys), index=pd.to_datetime(np.asarray(date_labels)), columns=np.asarray(key_labels, dtype=object))
+    return totals.reindex(index=dates, fill_value=0)
+
+def get_counties_nyt(state, data_dir='covid-19-data', data=None):
+    """Lowercase names of all counties of a given (lowercase) state
+
+    data : optional table from load_nyt('county'), to avoid re-reading us-counties.csv
+    """
+
+    if data is None:
+        data = load_nyt('county', data_dir=data_dir)
+
+    keys = nyt_keys(data, 'county').dropna().unique()
+    counties = np.array([key.split(':', 1)[1] for key in keys if key.split(':', 1)[0] == state], dtype=object)
 
     return counties
 
@@ -134,136 +785,151 @@ def scrape_regional_data_nyt(region="new jersey",
                              start_date=datetime.date(2020, 1, 25),
                              data_dir="covid-19-data",
                              data_src=None,
+                             data=None,
                              **kwargs):
 
     """Scrape data for a given region and store in local csv file
     
     Parameters
     ----------
-    region : name of region, e.g. "new jersey", or "new jersey:mercer"
+    region : name of region, e.g. "new jersey", or "new jersey:mercer", or a list thereof to be summed; None sums the whole table
     region_type : "state" or "country" or "county"
     var_to_track : e.g. "Deaths" / "Confirmed" / "Recovered"
     start_date : datetime date object, e.g. datetime.date(2020, 1, 1)
+    data : optional table from load_nyt, to avoid re-reading the source file
 
     Returns
     -------
     regional_data : pd Series with index of dates and values of var_to_track
     """
 
-    column_rename = {'deaths': 'Deaths',
-                     'cases': 'Confirmed',
-                    }
-    value_relabel = {
-                     'District of Columbia': 'DC',
-                     }
+    if region_type == 'county' and region is not None: # None sums every county
+        regions = region if isinstance(region, list) else [region]
+        if not all(isinstance(r, str) and ':' in r for r in regions):
+            raise ValueError(f'region should be a "state:county" key or a list of them for region_type="county", got {region!r}')
 
-    if region is not None:
-        if not isinstance(region, list):
-            region = [region]
-        region = [r.lower() for r in region]
+    if data is None:
+        data = load_nyt(region_type, data_dir=data_dir, data_src=data_src)
 
-    end_date = datetime.date.today()
-    time_delta = end_date - start_date
-    n_days = time_delta.days
+    result = aggregate_nyt(data, {'region': region}, region_type=region_type, var_to_track=var_to_track, start_date=start_date)
+    return result['region'].rename(None)
 
-    # load in nyt data
-    if region_type == 'state':
-        data_src = os.path.join(data_dir, 'us-states.csv')
-    elif region_type == 'county':
-        data_src = os.path.join(data_dir, 'us-counties.csv')
-    else:
-        assert data_src is not None, 'Without region specified, data src must be explicitly provided.'
-    data = pd.read_csv(data_src)
+def aggregate_nyt(data, regions, region_type="state", var_to_track="Deaths", start_date=datetime.date(2020, 1, 25), end_date=None, corrections=None):
+    """Sum an NYT table into one cumulative series per region in a single pivot
 
-    # clean up
-    data.rename(column_rename, axis=1, inplace=True)
-    data.replace(value_relabel, inplace=True)
+    Parameters
+    ----------
+    data : table from load_nyt
+    regions : dict of output name -> region key or list of keys (e.g. a state grouping, or several "state:county" keys); None sums the whole table
+    region_type : "state" or "county" or "country"
+    corrections : optional list to which the cells changed by correct_monotonic are appended
 
-    # collect only rows from region of interest
-    if region is None:
-        is_region = pd.Series(np.ones(len(data)).astype(bool))
-    else:
-        if region_type == 'state':
-            is_region = data['state'].str.lower().isin(region)
-        elif region_type == 'county':
-            assert all([':' in r for r in region]), 'County key must be "state:county"'
-            _states, _counties = np.array(list(zip(*[r.split(':') for r in region])))
-
-            statel = data.state.str.lower()
-            countyl = data.county.str.lower()
-            is_region = pd.Series(np.zeros(len(data)).astype(bool), index=data.index)
-            for _state, _county in zip(_states, _counties):
-                is_region = (is_region) | ((statel==_state) & (countyl==_county))
-
-    data = data[is_region]
-
-    # grab and calculate totals for given region    
-    dates = np.zeros(n_days, dtype='datetime64[s]')
-    totals = np.zeros(n_days)
-
-    for day in range(n_days):
-        # specify day of interest and relevant data file
-        date = start_date + datetime.timedelta(days=day)
-        datestr = date.strftime('%Y-%m-%d')
-
-        is_date = data['date'] == datestr
-        rows = data[is_date]
-
-        # collect values of relevant variable (e.g. deaths)
-        if len(rows) == 0:
-            total = 0
-        else:
-            values = rows[var_to_track].values
-            total = np.nansum(values)
-
-        # store values
-        dates[day] = np.datetime64(date)
-        totals[day] = total
-
-    # correct for any errors where day n+1 has less than day n
-    dif = np.append(0, np.diff(totals))
-    while np.any(dif < 0):
-        i_issue = np.argwhere(dif < 0)[:,0]
-        for i in i_issue:
-            totals[i] = totals[i-1]
-        dif = np.append(0, np.diff(totals))
-    assert np.all(np.diff(totals) >= 0), 'Non monotonic cumulative values'
-
-    result = pd.Series(totals, index=dates)
-    return result
+    Returns
+    -------
+    DataFrame with index of dates and one column per entry in `regions`
+    """
+    totals = pivot_nyt(data, region_type=region_type, var_to_track=var_to_track, start_date=start_date, end_date=end_date)
+    return _aggregate_regions(totals, regions, corrections=corrections)
 
 def scrape_all_regions(**kw):
     """Run scrape_regional_data on all states and return merged DataFrame
+
+    var_to_track may be a list of variables, in which case a dict of variable -> DataFrame is returned; every source file is still only read once, since each holds all variables.
+
+    source is "jhu" (daily reports), "jhu_ts" (JHU wide time series files; a few reads instead of one per day), or "nyt" (for US states; countries come from the daily reports).
+
+    Pass a list as `corrections` to collect every cell changed to keep the cumulative series non-decreasing (see correct_monotonic), with a variable column added.
+
+    Pass cache_dir to only parse source files that changed since the last run. Each source file is read once: JHU daily reports into a long table, NYT tables into a date x region pivot, which all regions are then aggregated from. `workers` sets the number of processes reading the JHU daily reports (see load_jhu_daily_reports). A long-running process can also pass a dict as `memory` to hold the cached tables between calls instead of loading them from cache_dir each time.
+
+    groupings : optional dict of name -> list of states, summed like ALL_US_REGIONS and added after them (e.g. the "state" groupings of load_groupings)
     """
     src = kw.pop('source', 'jhu')
-    
-    # STATES
-    print('Scraping US states.')
-    series_states = {state:scrape_regional_data(state, source=src, **kw) for state in ALL_STATES}
-    data_states = pd.DataFrame(series_states)
-    
-    # US state groupings (e.g. Northeast)
-    print('Scraping US state groupings.')
-    series_us_regions = {usr:scrape_regional_data(usr_contents, source=src, **kw) for usr,usr_contents in ALL_US_REGIONS.items()}
-    data_us_regions = pd.DataFrame(series_us_regions)
-
-    # COUNTRIES
-    print('Scraping countries.')
-    print('\tUsing JHU for country data except for US.')
-    series_countries = {cou:scrape_regional_data(cou, region_type='country', source='jhu', **kw) for cou in ALL_COUNTRIES}
+    var_to_track = kw.get('var_to_track', 'Deaths')
+    start_date = kw.get('start_date', datetime.date(2020, 1, 25))
+    data_dir = kw.get('data_dir', 'covid-19-data')
+    cache_dir = kw.get('cache_dir', None)
+    memory = kw.get('memory', None)
+    corrections = kw.get('corrections', None)
+    groupings = {**ALL_US_REGIONS, **kw.get('groupings', {})}
+    jhu_kw = {k: kw[k] for k in ('start_date', 'data_src_template', 'cache_dir', 'workers', 'memory') if k in kw}
+    variables = var_to_track if isinstance(var_to_track, list) else [var_to_track]
+
+    if src == 'jhu_ts':
+        print('Reading JHU time series.')
+        table = load_jhu_time_series(variables, **{k: kw[k] for k in ('data_src_template',) if k in kw})
+    else:
+        print('Reading JHU daily reports.')
+        table = load_jhu_daily_reports(**jhu_kw)
     if src == 'nyt':
-        series_countries['US'] = scrape_regional_data_nyt(None, region_type='country', data_src='covid-19-data/us.csv', **kw)
-    data_countries = pd.DataFrame(series_countries)
-    
-    return pd.concat([data_states, data_countries, data_us_regions], axis=1)
+        print('Reading NYT state data.')
+        nyt_states = load_nyt('state', data_dir=data_dir, cache_dir=cache_dir, memory=memory)
+        nyt_us = load_nyt('country', data_src=os.path.join(data_dir, 'us.csv'), cache_dir=cache_dir, memory=memory)
+
+    results = {}
+    for var in variables:
+        var_corrections = []
+        agg_kw = dict(var_to_track=var, start_date=start_date)
+        if src in ('jhu', 'jhu_ts'):
+            aggregate = lambda regions: aggregate_jhu(table, regions, corrections=var_corrections, **agg_kw)
+        elif src == 'nyt':
+            totals = pivot_nyt(nyt_states, **agg_kw)
+            aggregate = lambda regions: _aggregate_regions(totals, regions, corrections=var_corrections)
+
+        # STATES
+        print(f'Scraping US states ({var}).')
+        data_states = aggregate({state:state for state in ALL_STATES})
+
+        # US state groupings (e.g. Northeast)
+        print(f'Scraping US state groupings ({var}).')
+        data_us_regions = aggregate(groupings)
+
+        # COUNTRIES
+        print(f'Scraping countries ({var}).')
+        print('\tUsing JHU for country data except for US.')
+        data_countries = aggregate_jhu(table, {cou:cou for cou in ALL_COUNTRIES}, region_type='country', corrections=var_corrections, **agg_kw)
+        if src == 'nyt':
+            var_corrections = [c[c.region != 'US'] for c in var_corrections]
+            data_countries['US'] = aggregate_nyt(nyt_us, {'US': None}, region_type='country', corrections=var_corrections, **agg_kw)['US']
+
+        results[var] = pd.concat([data_states, data_countries, data_us_regions], axis=1)
+        if corrections is not None:
+            corrections.extend(c.assign(variable=var) for c in var_corrections)
+
+    return results if isinstance(var_to_track, list) else results[var_to_track]
 
 def scrape_all_counties(**kw):
+    """Scrape every county of every state in ALL_STATES from a single streaming pass over us-counties.csv (see load_nyt_totals)
+
+    var_to_track may be a list of variables, in which case a dict of variable -> table is returned. Pass a list as `corrections` to collect corrected cells, and cache_dir and `memory` to reuse the totals of the last run, as in scrape_all_regions.
+
+    The tables are OffsetTables (see storage.OffsetTable): each county is only stored from its first case, so memory scales with the number of observations rather than with dates x counties. `storage.as_frame` makes one a DataFrame.
+
+    groupings : optional dict of name -> list of "state:county" keys (e.g. metro areas, the "county" groupings of load_groupings), added as columns after the counties
+    """
+    var_to_track = kw.get('var_to_track', 'Deaths')
+    start_date = kw.get('start_date', datetime.date(2020, 1, 25))
+    data_dir = kw.get('data_dir', 'covid-19-data')
+    cache_dir = kw.get('cache_dir', None)
+    memory = kw.get('memory', None)
+    corrections = kw.get('corrections', None)
+    groupings = kw.get('groupings', {})
+    variables = var_to_track if isinstance(var_to_track, list) else [var_to_track]
 
     # US COUNTIES
     print('Scraping US counties.')
     print('\tUsing NYT for US county data.')
-    series_us_counties = {f'{state.lower()}:{county}':scrape_regional_data_nyt(f'{state.lower()}:{county}', region_type='county', source='nyt', **kw) for state in ALL_STATES for county in get_counties_nyt(state.lower())}
-    data_us_counties = pd.DataFrame(series_us_counties)
-
-    return data_us_counties
-    
+    totals = load_nyt_totals('county', data_dir=data_dir, cache_dir=cache_dir, memory=memory)
+    dates = pd.DatetimeIndex([pd.Timestamp(d) for d in _date_range(start_date)])
+    state_order = {state.lower():i for i,state in enumerate(ALL_STATES)}
+    keys = [key for key in totals['key'].cat.categories if key.split(':')[0] in state_order]
+    keys = sorted(keys, key=lambda key: state_order[key.split(':')[0]]) # grouped by state, in order of first appearance
+
+    results = {}
+    for var in variables:
+        var_corrections = []
+        results[var] = _aggregate_observations(totals, var, dates, {**{key:key for key in keys}, **groupings}, corrections=var_corrections)
+        if corrections is not None:
+            corrections.extend(c.assign(variable=var) for c in var_corrections)
+
+    return results if isinstance(var_to_track, list) else results[var_to_track]
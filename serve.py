@@ -0,0 +1,261 @@
+"""
+Local HTTP service for the series, metrics and plots of any region, county or grouping, on demand.
+
+It reads the tables written by main.py (data/scraped_data-{var}.csv and data/scraped_data_us_counties-{var}.csv, via their npz copies), so a pipeline run (or watch.py) keeps it current. Responses are kept in an in-memory LRU cache limited in bytes, which is emptied whenever one of the tables changes. Plots are drawn by a pool of processes, each with its own matplotlib state, so that concurrent requests are not serialized on it.
+
+    python3 serve.py --port 8000
+
+    /regions?scope=counties                                     region names
+    /series?region=US&region=New York&variable=Confirmed        cumulative counts (json, or &format=csv)
+    /metric?region=US&metric=doubling_time&window=7             a metric of calculations.METRICS (json or csv)
+    /plot?region=US&region=Ohio&metric=fold_change&days=40      image of a metric of PLOT_METRICS (&fmt=png, webp or svg)
+
+Every request takes region (repeated, in order of the plot lines), variable (Deaths or Confirmed) and scope (regions, or counties named `state:county`). Plots also take title, ylabel, log, runaway_zone, simplified and days (number of days shown).
+"""
+
+import os, json, shutil, argparse, datetime, tempfile, threading, traceback, collections
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+from calculations import compute_metrics, c_str, METRICS
+from storage import load_frame, columnar_path
+from manifest import show_n_days
+import displays
+
+host = '127.0.0.1' # local only
+port = 8000
+cache_max_bytes = 256 * 2**20 # responses kept in memory; the least recently used are evicted beyond this size
+plot_workers = None # processes drawing plots (None: one per core)
+data_dir = 'data'
+TABLES = {'regions': 'scraped_data-{var}.csv', # scope -> table written by main.py
+          'counties': 'scraped_data_us_counties-{var}.csv'}
+IMAGE_TYPES = {'png': 'image/png', 'webp': 'image/webp', 'svg': 'image/svg+xml'}
+PLOT_METRICS = ['fold_change', 'doubling_time', 'regression_doubling_time'] # metrics on the scale of the plots (values above displays.clip_value are not drawn)
+
+class LRUCache:
+    """Thread-safe mapping of keys to (body, content type) responses, evicting the least recently used beyond max_bytes of bodies
+    """
+
+    def __init__(self, max_bytes=cache_max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= len(self.entries.pop(key)[0])
+            if len(value[0]) > self.max_bytes:
+                return
+            self.entries[key] = value
+            self.nbytes += len(value[0])
+            while self.nbytes > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.nbytes -= len(old[0])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+cache = LRUCache()
+_tables = {} # path -> (signature, table)
+_tables_lock = threading.Lock()
+_pool = None # plot processes, started by serve
+
+def table_path(scope, variable):
+    if scope not in TABLES:
+        raise ValueError(f'Unknown scope {scope}, expected one of {", ".join(TABLES)}')
+    return os.path.join(data_dir, TABLES[scope].format(var=variable))
+
+def _signature(path):
+    """mtime and size of a table and of its npz copy, which change whenever main.py rewrites it
+    """
+    sig = []
+    for p in (path, columnar_path(path)):
+        try:
+            stat = os.stat(p)
+            sig.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            sig.append(None)
+    return tuple(sig)
+
+def load_table(scope, variable):
+    """Scraped table of a scope and variable, and its signature; reloaded, and the response cache emptied, when the file changed
+    """
+    path = table_path(scope, variable)
+    sig = _signature(path)
+    if sig == (None, None):
+        raise LookupError(f'No {variable} table for {scope}; run main.py first')
+    with _tables_lock:
+        if path not in _tables or _tables[path][0] != sig:
+            if path in _tables:
+                cache.clear() # every response depends on the data
+            _tables[path] = (sig, load_frame(path))
+        return _tables[path][1], sig
+
+def select(table, regions):
+    """Columns of the table for the requested regions, in order, matching names case-insensitively
+    """
+    if not regions:
+        raise ValueError('No region given')
+    names = {c.lower(): c for c in table.columns}
+    missing = [r for r in regions if r.lower() not in names]
+    if missing:
+        raise LookupError(f'Unknown region(s): {", ".join(missing)}')
+    return table[[names[r.lower()] for r in regions]]
+
+def calculated(table, params):
+    """The requested metric of the requested regions, over the whole table
+    """
+    data = select(table, params['region'])
+    metric, window = params['metric'], int(params['window'])
+    if metric not in METRICS:
+        raise ValueError(f'Unknown metric {metric}, expected one of {", ".join(METRICS)}')
+    return compute_metrics(data, metrics={metric: [window]})[metric, window]
+
+def encode(data, fmt):
+    """Body and content type of a date x region table, as csv or as json ({"dates": [...], "series": {region: [...]}}, with null for missing or infinite values)
+    """
+    if fmt == 'csv':
+        return data.to_csv().encode(), 'text/csv'
+    if fmt != 'json':
+        raise ValueError(f'Unknown format {fmt}, expected json or csv')
+    values = np.asarray(data.values, dtype=float)
+    body = dict(dates=[str(d.date()) for d in pd.to_datetime(data.index)],
+                series={c: [float(v) if np.isfinite(v) else None for v in values[:, i]] for i, c in enumerate(data.columns)})
+    return json.dumps(body, separators=(',', ':')).encode(), 'application/json'
+
+def plot_spec(params, data):
+    """Keyword arguments to displays.generate_plot from the request parameters, with the defaults of manifest.plot_specs
+    """
+    flag = lambda name, default: params[name].lower() in ('1', 'true', 'yes') if name in params else default
+    fmt = params.get('fmt', 'png')
+    if fmt not in IMAGE_TYPES:
+        raise ValueError(f'Unknown image format {fmt}, expected one of {", ".join(IMAGE_TYPES)}')
+    metric, window = params['metric'], int(params['window'])
+    if metric not in PLOT_METRICS:
+        raise ValueError(f'Metric {metric} cannot be plotted, expected one of {", ".join(PLOT_METRICS)}')
+    return dict(columns=list(data.columns),
+                title=params.get('title', ''),
+                ylabel=params.get('ylabel', c_str(metric, params['variable'], window)),
+                log=flag('log', metric == 'fold_change'),
+                runaway_zone=flag('runaway_zone', metric == 'doubling_time'),
+                simplified=flag('simplified', False),
+                bolds=[0],
+                min_date=pd.Timestamp.today() - pd.to_timedelta(int(params.get('days', show_n_days)), unit='D'),
+                fmt=fmt)
+
+def _init_plot_worker():
+    # one image in one format per request
+    displays.extra_formats = []
+    displays.thumbnail_widths = []
+    displays.write_svg = False
+
+def _render(data, spec):
+    """Draw a plot in a temporary directory and return the image
+    """
+    out_dir = tempfile.mkdtemp()
+    try:
+        path = displays.generate_plot(data, out_dir=out_dir, **spec)
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        shutil.rmtree(out_dir)
+
+def get_regions(table, params):
+    return json.dumps(list(table.columns)).encode(), 'application/json'
+
+def get_series(table, params):
+    return encode(select(table, params['region']), params.get('format', 'json'))
+
+def get_metric(table, params):
+    return encode(calculated(table, params), params.get('format', 'json'))
+
+def get_plot(table, params):
+    """Image of the requested metric; a ValueError (400) when none of the regions has a value to draw, as raised by displays.generate_plot
+    """
+    data = calculated(table, params)
+    spec = plot_spec(params, data)
+    if _pool is None:
+        return _render(data, spec), IMAGE_TYPES[spec['fmt']]
+    return _pool.submit(_render, data, spec).result(), IMAGE_TYPES[spec['fmt']]
+
+ROUTES = {'/regions': get_regions, '/series': get_series, '/metric': get_metric, '/plot': get_plot}
+
+def respond(path, query):
+    """Status, content type and body of the response to a request, from the cache when possible
+
+    query : parsed query string, as from urllib.parse.parse_qs
+    """
+    if path not in ROUTES:
+        return 404, 'application/json', json.dumps(dict(error=f'Unknown path {path}, expected one of {", ".join(ROUTES)}')).encode()
+    params = {k: v[-1] for k, v in query.items()}
+    params['region'] = query.get('region', [])
+    params.setdefault('scope', 'regions')
+    params.setdefault('variable', 'Deaths')
+    params.setdefault('metric', 'doubling_time')
+    params.setdefault('window', '3')
+
+    try:
+        table, sig = load_table(params['scope'], params['variable'])
+        # plots depend on today's date through the days shown
+        key = repr((path, sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in params.items()), sig, str(datetime.date.today())))
+        response = cache.get(key)
+        if response is None:
+            response = ROUTES[path](table, params)
+            cache.put(key, response)
+        body, content_type = response
+        return 200, content_type, body
+    except LookupError as e:
+        return 404, 'application/json', json.dumps(dict(error=str(e))).encode()
+    except ValueError as e:
+        return 400, 'application/json', json.dumps(dict(error=str(e))).encode()
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        try:
+            status, content_type, body = respond(url.path, parse_qs(url.query))
+        except Exception:
+            traceback.print_exc()
+            status, content_type, body = 500, 'application/json', json.dumps(dict(error='Internal error, see the server log')).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def serve(host=host, port=port, workers=plot_workers):
+    """Serve requests (each in its own thread) until interrupted
+    """
+    global _pool
+    _pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1, initializer=_init_plot_worker)
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f'Serving on http://{host}:{server.server_port}/ (data from {data_dir}/).')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        _pool.shutdown()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--host', default=host)
+    parser.add_argument('--port', type=int, default=port)
+    parser.add_argument('--workers', type=int, default=plot_workers, help='processes drawing plots (default: one per core)')
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers)
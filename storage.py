@@ -0,0 +1,211 @@
+import os, json, gzip, zipfile, hashlib
+import numpy as np
+import pandas as pd
+
+def columnar_path(filename):
+    """Path of the columnar (npz) copy that accompanies a csv data table
+    """
+    return os.path.splitext(filename)[0] + '.npz'
+
+def file_hash(path, size=None):
+    """sha1 of the content of a file, or of its first `size` bytes, read a block at a time
+    """
+    h = hashlib.sha1()
+    remaining = float('inf') if size is None else size
+    with open(path, 'rb') as f:
+        while remaining > 0:
+            block = f.read(int(min(2**20, remaining)))
+            if not block:
+                break
+            h.update(block)
+            remaining -= len(block)
+    return h.hexdigest()
+
+def file_signature(path, previous=None):
+    """Size, mtime and content hash of a file, to tell whether it changed since `previous` (e.g. for the scrape cache and for publishing)
+
+    The content hash is only recomputed when mtime or size differ from the `previous` signature.
+    """
+    stat = os.stat(path)
+    sig = {'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+    if previous is not None and previous['mtime'] == sig['mtime'] and previous['size'] == sig['size']:
+        sig['sha1'] = previous['sha1']
+    else:
+        sig['sha1'] = file_hash(path)
+    return sig
+
+block_rows = 128 # rows of an OffsetTable made dense at once when it is saved
+block_columns = 256 # columns of an OffsetTable made dense at once when it is corrected or calculated
+
+class OffsetTable:
+    """Compact date x region table, for many regions that each start late (e.g. US counties, most of which had no cases for months)
+
+    Each column is stored from its first value that differs from `fill` to the last date, so memory scales with the number of observations rather than with dates x regions. Columns are processed a block at a time, as dense arrays (see `dense`).
+
+    index, columns : as those of the equivalent DataFrame
+    starts : row of the first stored value of each column (len(index) for a column that is all fill)
+    values : stored values of every column, one column after another; column j is values[indptr[j]:indptr[j + 1]]
+    fill : value of every row before the start of a column (0 for counts, NaN for metrics)
+    """
+
+    def __init__(self, index, columns, starts, values, fill=0.):
+        self.index = pd.DatetimeIndex(index)
+        self.columns = pd.Index(columns)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.values = values
+        self.fill = fill
+        self.indptr = np.concatenate([[0], np.cumsum(len(self.index) - self.starts)])
+
+    @property
+    def shape(self):
+        return len(self.index), len(self.columns)
+
+    @classmethod
+    def from_dense(cls, values, index, columns, fill=0., dtype=None):
+        """Compact copy of a dense array (rows: dates), storing each column from its first value that differs from fill
+        """
+        values = np.asarray(values)
+        differs = ~np.isnan(values) if np.isnan(fill) else values != fill
+        starts = np.where(differs.any(axis=0), differs.argmax(axis=0), len(values))
+        stored = np.concatenate([values[start:, j] for j, start in enumerate(starts)] or [values[:0, 0]])
+        return cls(index, columns, starts, stored.astype(dtype or values.dtype), fill)
+
+    @classmethod
+    def from_observations(cls, index, columns, rows, cols, values, dtype=None):
+        """Table of counts summed from (row, column, value) observations, 0 elsewhere; each column is stored from its first nonzero observation
+
+        dtype : of the stored values; by default float32 where that is exact (every column sums to below 2**24 in absolute value), float64 otherwise
+        """
+        n_rows = len(index)
+        rows, cols, values = np.asarray(rows), np.asarray(cols), np.asarray(values)
+        nonzero = values != 0
+        rows, cols, values = rows[nonzero], cols[nonzero], values[nonzero]
+        if dtype is None:
+            dtype = np.float32 if np.all(np.bincount(cols, weights=np.abs(values), minlength=len(columns)) < 2**24) else float
+        starts = np.full(len(columns), n_rows, dtype=np.int64)
+        np.minimum.at(starts, cols, rows)
+        table = cls(index, columns, starts, None, 0.)
+        table.values = np.zeros(table.indptr[-1], dtype=dtype)
+        np.add.at(table.values, table.indptr[cols] + rows - starts[cols], values.astype(dtype)) # repeated cells add up
+        return table
+
+    @classmethod
+    def concat(cls, tables):
+        """Join tables of the same dates and fill side by side
+        """
+        return cls(tables[0].index, np.concatenate([t.columns for t in tables]), np.concatenate([t.starts for t in tables]),
+                   np.concatenate([t.values for t in tables]), tables[0].fill)
+
+    def take(self, positions):
+        """Table of the columns at `positions`, in that order
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        values = [self.values[self.indptr[j]:self.indptr[j + 1]] for j in positions]
+        return OffsetTable(self.index, self.columns[positions], self.starts[positions],
+                           np.concatenate(values) if values else self.values[:0], self.fill)
+
+    def dense(self, columns=slice(None), rows=slice(None), dtype=float):
+        """Values of a range of columns and rows (slices) as a dense array
+        """
+        col_start, col_stop, _ = columns.indices(len(self.columns))
+        row_start, row_stop, _ = rows.indices(len(self.index))
+        out = np.full((row_stop - row_start, col_stop - col_start), self.fill, dtype=dtype)
+        for j in range(col_start, col_stop):
+            start = max(self.starts[j], row_start)
+            if start < row_stop:
+                offset = self.indptr[j] - self.starts[j]
+                out[start - row_start:, j - col_start] = self.values[offset + start:offset + row_stop]
+        return out
+
+    def column_blocks(self, size=None):
+        """Slices of consecutive columns, `block_columns` at a time
+        """
+        size = size or block_columns
+        return [slice(j, min(j + size, len(self.columns))) for j in range(0, len(self.columns), size)]
+
+    def block_frame(self, columns):
+        """DataFrame of a block of columns (a slice), in float64
+        """
+        return pd.DataFrame(self.dense(columns), index=self.index, columns=self.columns[columns])
+
+    def to_frame(self):
+        return pd.DataFrame(self.dense(), index=self.index, columns=self.columns)
+
+def save_frame(data, filename):
+    """Save a date x region table as csv (e.g. for the web table) and as a typed columnar npz copy with a datetime index
+
+    filename : path to csv; the npz copy is written next to it
+    data : DataFrame, or OffsetTable, which is written a block of rows at a time without being made dense as a whole
+    """
+    path = columnar_path(filename)
+    tmp_path = path + '.tmp.npz'
+    index = pd.to_datetime(data.index).values.astype('datetime64[ns]')
+    columns = np.array(data.columns, dtype=str)
+
+    if not isinstance(data, OffsetTable):
+        data.to_csv(filename)
+        np.savez(tmp_path, index=index, columns=columns, values=np.ascontiguousarray(data.values, dtype=float))
+        os.replace(tmp_path, path)
+        return filename
+
+    # the same files as from the dense table, written by blocks of rows
+    blocks = [slice(i, i + block_rows) for i in range(0, len(data.index), block_rows)] or [slice(0, 0)]
+    with open(filename, 'w', newline='') as f:
+        for i, rows in enumerate(blocks):
+            pd.DataFrame(data.dense(rows=rows), index=data.index[rows], columns=data.columns).to_csv(f, header=i == 0)
+
+    # as np.savez, with the values streamed into the archive
+    with zipfile.ZipFile(tmp_path, mode='w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for name, array in [('index', index), ('columns', columns)]:
+            with archive.open(name + '.npy', 'w', force_zip64=True) as fid:
+                np.lib.format.write_array(fid, array)
+        with archive.open('values.npy', 'w', force_zip64=True) as fid:
+            np.lib.format.write_array_header_1_0(fid, dict(descr=np.lib.format.dtype_to_descr(np.dtype(float)), fortran_order=False, shape=data.shape))
+            for rows in blocks:
+                fid.write(data.dense(rows=rows).tobytes('C'))
+    os.replace(tmp_path, path)
+    return filename
+
+def save_json(obj, filename, compress=True):
+    """Save obj as minified JSON, with precompressed copies for the web server to send as is
+
+    compress : also write `{filename}.gz` and, if the brotli package is installed, `{filename}.br`
+
+    Each file is written to a temporary path and renamed into place, so readers never see a partial file.
+    """
+    content = json.dumps(obj, separators=(',', ':'), allow_nan=False).encode()
+    variants = {filename: content}
+    if compress:
+        variants[filename + '.gz'] = gzip.compress(content, compresslevel=9, mtime=0) # mtime=0: same data, same bytes
+        try:
+            import brotli
+            variants[filename + '.br'] = brotli.compress(content, quality=11)
+        except ImportError: # optional dependency
+            pass
+
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    for path, data in variants.items():
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+    return filename
+
+def load_frame(filename):
+    """Load a table saved by save_frame, preferring the columnar copy unless the csv is newer
+
+    filename : path to csv
+    """
+    path = columnar_path(filename)
+    if os.path.exists(path) and (not os.path.exists(filename) or os.path.getmtime(path) >= os.path.getmtime(filename)):
+        with np.load(path, allow_pickle=False) as npz:
+            return pd.DataFrame(npz['values'], index=pd.DatetimeIndex(npz['index']), columns=npz['columns'].tolist())
+    return pd.read_csv(filename, index_col=0, parse_dates=True)
+
+def as_frame(data):
+    """Accept either a DataFrame, an OffsetTable (made dense) or a path to a saved table
+    """
+    if isinstance(data, pd.DataFrame):
+        return data
+    if isinstance(data, OffsetTable):
+        return data.to_frame()
+    return load_frame(data)
@@ -0,0 +1,125 @@
+"""
+Long-running alternative to running main.py from cron: run the workflow whenever the data submodules change.
+
+The process stays up between runs, so pandas and matplotlib are imported once, the parsed source tables stay in memory (see scrape.scrape_all_regions) and the plots are rendered by a pool of processes started once, whose figure templates stay built (see displays.plot_pool). The source files are polled for changes (mtime and size); a change to the JHU files or the NYT state/national tables reruns the states and countries, a change to us-counties.csv reruns the counties, and a new day reruns everything. After each run the outputs can be published (see publish.py).
+
+A failed run is retried as soon as its source files change again; on unchanged files (e.g. a deterministic error in the data) it is only retried after a delay that doubles with each failure in a row, up to max_retry_delay, so that the error is not rerun at every poll.
+
+A status file records the state of the process, the last run, the pending retry if any and a heartbeat updated at every poll, for monitoring:
+
+    python3 watch.py deaths confirmed doubling_time fold_change --publish /web/www/data/covid-19
+
+Data still has to be pulled (e.g. `git submodule foreach git pull origin master` from cron); the pipeline runs within one poll interval of the pull.
+"""
+
+import os, sys, glob, json, time, signal, datetime, argparse, traceback
+import main, displays
+from scrape import JHU_DAILY_TEMPLATE, JHU_TS_TEMPLATE
+
+poll_interval = 30 # seconds between checks of the source files
+max_retry_delay = 3600 # longest wait in seconds before a failed run is retried on unchanged source files
+status_file = 'status.json' # health/status of the watch process (kept out of data/, which is published)
+
+# parts of the workflow (see main.run) -> the source files they read
+WATCHED = {
+    'regions': [os.path.join(os.path.dirname(JHU_DAILY_TEMPLATE), '*.csv'),
+                os.path.join(os.path.dirname(JHU_TS_TEMPLATE), '*.csv'),
+                'covid-19-data/us-states.csv',
+                'covid-19-data/us.csv',
+                main.groupings_file],
+    'counties': ['covid-19-data/us-counties.csv',
+                 main.groupings_file],
+}
+
+def snapshot(patterns):
+    """(mtime, size) of every file matching the glob patterns
+    """
+    files = {}
+    for pattern in patterns:
+        for path in glob.glob(pattern):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError: # removed meanwhile
+                continue
+            files[path] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+def write_status(status, filename=status_file):
+    status['heartbeat'] = datetime.datetime.now().isoformat(timespec='seconds')
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(status, f, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+def watch(variables=main.variables, calculation_kinds=main.calculation_kinds, data_source=main.data_source, interval=poll_interval, publish_root=None, once=False):
+    """Run the workflow at start and then again whenever its source files change, until interrupted
+
+    publish_root : web directory to publish to after each successful run (see publish.publish), or None
+    once : return after the first run (e.g. to check the status file)
+    """
+    parts = ['regions'] + (['counties'] if main.analyze_us_counties else [])
+    status = dict(state='starting', pid=os.getpid(), started=datetime.datetime.now().isoformat(timespec='seconds'), runs=0, failures=0, parts=parts)
+    write_status(status)
+
+    state = dict(tables={}, plot_pool=displays.plot_pool(main.plot_workers)) # kept between runs, see main.run
+    seen = {part: None for part in parts} # source files at the last run of each part
+    failed = {} # part -> source files at its last failed run
+    failures_in_a_row, retry_at = 0, None # retry_at: time.monotonic() after which failed runs are retried on unchanged files
+    day = None
+    try:
+        while True:
+            today = datetime.date.today()
+            current = {part: snapshot(WATCHED[part]) for part in parts}
+            due = parts if today != day else [part for part in parts if current[part] != seen[part]]
+            todo = [part for part in due if current[part] != failed.get(part) or time.monotonic() >= retry_at]
+
+            if todo:
+                print(f'{datetime.datetime.now():%Y-%m-%d %H:%M:%S} Running {" and ".join(todo)}.')
+                status.update(state='running', running=todo, last_start=datetime.datetime.now().isoformat(timespec='seconds'))
+                write_status(status)
+                t0 = time.perf_counter()
+                try:
+                    main.run(variables, calculation_kinds, data_source, regions='regions' in todo, counties='counties' in todo, state=state)
+                    if publish_root is not None:
+                        import publish
+                        publish.publish(publish_root)
+                except Exception: # logged, and retried once the source files change or after the retry delay
+                    traceback.print_exc()
+                    failed.update({part: current[part] for part in todo})
+                    failures_in_a_row += 1
+                    delay = min(interval * 2 ** failures_in_a_row, max_retry_delay)
+                    retry_at = time.monotonic() + delay
+                    status.update(failures=status['failures'] + 1, last_error=traceback.format_exc(), last_failure=datetime.datetime.now().isoformat(timespec='seconds'),
+                                  retry=dict(parts=sorted(failed), failures_in_a_row=failures_in_a_row,
+                                             next_attempt=(datetime.datetime.now() + datetime.timedelta(seconds=delay)).isoformat(timespec='seconds'),
+                                             on_change=True)) # or as soon as the source files of a part change
+                else:
+                    seen.update({part: current[part] for part in todo})
+                    day = today
+                    for part in todo:
+                        failed.pop(part, None)
+                    if not failed:
+                        failures_in_a_row, retry_at = 0, None
+                        status.pop('retry', None)
+                    status['last_success'] = datetime.datetime.now().isoformat(timespec='seconds')
+                status.update(state='idle', runs=status['runs'] + 1, last_parts=todo, last_duration_s=round(time.perf_counter() - t0, 3), last_end=datetime.datetime.now().isoformat(timespec='seconds'))
+                status.pop('running', None)
+
+            write_status(status)
+            if once:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        state['plot_pool'].shutdown()
+        status['state'] = 'stopped'
+        write_status(status)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--interval', type=float, default=poll_interval, help='seconds between checks of the source files')
+    parser.add_argument('--publish', metavar='ROOT', help='web directory to publish to after each run')
+    parser.add_argument('--once', action='store_true', help='run once and exit')
+    args, rest = parser.parse_known_args()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) # e.g. from systemd or kill; the status file then reads 'stopped'
+    watch(*main.parse_args(rest), interval=args.interval, publish_root=args.publish, once=args.once)
@@ -0,0 +1,70 @@
+"""
+Compact data for the web table (covid19-table.html): one row per state with its total deaths and its doubling time now and a week ago.
+
+The table used to download the full scraped and doubling time csvs to read three values per state; `table_data` computes those rows (and every sort order the page offers) here instead.
+"""
+
+import numpy as np
+import pandas as pd
+from scrape import ALL_STATES
+from storage import save_json
+
+TABLE_COLUMNS = ['State', 'Deaths', 'Now', 'Last Week'] # also the sort keys offered by the page
+TABLE_REGIONS = ALL_STATES # rows of the table, besides the US row shown first
+week_ago = 7 # rows back from the latest date for the 'Last Week' column
+
+def _number(value):
+    """JSON-safe value: None for NaN, 'Infinity' or '-Infinity' for infinite values (numbers again in the page), int for whole numbers"""
+    value = float(value)
+    if np.isnan(value):
+        return None
+    if np.isinf(value):
+        return 'Infinity' if value > 0 else '-Infinity'
+    return int(value) if value.is_integer() else value
+
+def _sort_value(value):
+    """Value as the page compares it, with infinite values as numbers"""
+    return float(value) if value in ('Infinity', '-Infinity') else value
+
+def table_data(scraped, doubling_time):
+    """Rows of the web table, with every sort order precomputed
+
+    Parameters
+    ----------
+    scraped : date x region table of cumulative counts
+    doubling_time : date x region table of doubling times
+
+    Returns
+    -------
+    dict with the latest date, the column names, the US row, the state rows (as lists in column order) and `order`, the row indices for each sort direction and key
+
+    States whose doubling time now or a week ago is missing or zero are left out, as the page always did (as are states without a total). Infinite doubling times (no new deaths over the window) are kept, shown as "Infinity d" and sorted above every finite value.
+    """
+    total = scraped.iloc[-1]
+    now = doubling_time.iloc[-1]
+    last_week = doubling_time.iloc[-1 - week_ago]
+
+    rows = []
+    for region in TABLE_REGIONS:
+        if region not in scraped.columns:
+            continue
+        values = [_number(total[region]), _number(now[region]), _number(last_week[region])]
+        if values[0] is None or not values[1] or not values[2]: # None or 0
+            continue
+        rows.append([region] + values)
+
+    # stable sorts, like Array.prototype.sort in the page
+    order = {direction: {key: sorted(range(len(rows)), key=lambda i: _sort_value(rows[i][k]), reverse=direction == 'descending')
+                         for k, key in enumerate(TABLE_COLUMNS)}
+             for direction in ('ascending', 'descending')}
+
+    return dict(date=str(pd.to_datetime(doubling_time.index[-1]).date()),
+                columns=TABLE_COLUMNS,
+                us=['US', _number(total['US']), _number(now['US']), _number(last_week['US'])],
+                rows=rows,
+                order=order)
+
+def save_table_data(scraped, doubling_time, filename='data/covid19-table.json'):
+    """Write the web table rows as minified JSON (with .gz/.br copies, see storage.save_json) and return the path
+    """
+    return save_json(table_data(scraped, doubling_time), filename)